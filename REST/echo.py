@@ -44,12 +44,14 @@ import functions
 parser = argparse.ArgumentParser(os.path.basename(__file__))
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
 parser.add_argument("string", help="String to send for echo", type=str)
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 print("Sending echo request for ", args.string, file=sys.stderr)
 
@@ -48,6 +48,7 @@ parser.add_argument("site", help="Name of the site as specified in settings.yaml
 parser.add_argument("-i", "--iccid", help="Device ICCID", type=str, action="append")
 parser.add_argument("-l", "--list", help="File with ICCIDs and params to change", type=str)
 parser.add_argument("-p", "--param", type=str, default="", help="Parameters to modify in JSON format")
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
@@ -72,6 +73,7 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 alldevices=[]
 print(f"Processing {len(iccids)} ICCIDs", file=sys.stderr)
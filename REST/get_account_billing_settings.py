@@ -46,6 +46,9 @@ parser.add_argument("site", help="Name of the site as specified in settings.yaml
 parser.add_argument("-a", "--account", help="ID of the account", type=str, action='append')
 parser.add_argument("-l", "--list", help="File with account IDs", type=str)
 parser.add_argument("-f", "--fields", type=str, default='', help='Attributes to print from JSON')
+parser.add_argument("--no-cache", dest="cache", action='store_const', const="off", default="use", help="Do not use the response cache")
+parser.add_argument("--refresh", dest="cache", action='store_const', const="refresh", help="Refresh the response cache")
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
@@ -70,6 +73,7 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 alldetails=[]
 
@@ -97,6 +101,7 @@ for account in accounts:
         settings["username"], 
         settings["apikey"], 
         {}, 
+        cache=args.cache,
         debug=args.debug))
     jData["id"] = acctid
     if acctname != "":
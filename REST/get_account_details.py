@@ -46,6 +46,11 @@ parser.add_argument("site", help="Name of the site as specified in settings.yaml
 parser.add_argument("-a", "--account", help="ID of the account", type=str, action='append')
 parser.add_argument("-l", "--list", help="File with account IDs", type=str)
 parser.add_argument("-f", "--fields", type=str, default='', help='Attributes to print from JSON')
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of requests to run in parallel")
+parser.add_argument("--no-cache", dest="cache", action='store_const', const="off", default="use", help="Do not use the response cache")
+parser.add_argument("--refresh", dest="cache", action='store_const', const="refresh", help="Refresh the response cache")
+parser.add_argument("-e", "--errors", type=str, help="Continue after failed requests and write the failed account IDs to this CSV file")
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
@@ -70,22 +75,23 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
-alldetails=[]
+print(f"Processing {len(accounts)} accounts with concurrency {args.concurrency}", file=sys.stderr)
 
-print(f"Processing {len(accounts)} accounts", file=sys.stderr)
-for account in accounts:
-
-    print(f"Requesting details for account {account}", file=sys.stderr)
-
-    jData = json.loads(functions.get_data(
+# Request the details of a single account
+#
+def get_details(account):
+    return json.loads(functions.get_data(
         settings["resturl"] + "/accounts/" + account + fields,
         settings["username"], 
         settings["apikey"], 
         {}, 
-        debug=args.debug))
+        cache=args.cache,
+        debug=args.debug,
+        bad_request="raise"))
 
-    alldetails.append(jData)
+alldetails = functions.run_bulk(accounts, get_details, args.concurrency, args.errors)
 
 # Dump the result
 #
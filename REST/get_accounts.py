@@ -28,7 +28,6 @@ __version__ = "1.0.0"
 __copyright__ = "Copyright (c) 2023 Cisco and/or its affiliates."
 __license__ = "Cisco Sample Code License, Version 1.1"
 
-import json
 import os
 import argparse
 import sys
@@ -43,34 +42,31 @@ import functions
 #
 parser = argparse.ArgumentParser(os.path.basename(__file__))
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
+parser.add_argument("--no-cache", dest="cache", action='store_const', const="off", default="use", help="Do not use the response cache")
+parser.add_argument("--refresh", dest="cache", action='store_const', const="refresh", help="Refresh the response cache")
+parser.add_argument("-p", "--prefetch", type=int, default=0, help="Number of pages to request ahead in parallel")
+parser.add_argument("--jsonl", help="Stream the records as JSON lines while they are received", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
-accounts=[]
-page = 1
-lastpage = False
+accounts = functions.RecordWriter(jsonl=args.jsonl)
 
-while not lastpage:
-
-    print(f"Requesting page {page}", file=sys.stderr)
-
-    params={"pageNumber": page}
-
-    jData = json.loads(functions.get_data(
+for page, jData in functions.get_pages(
         settings["resturl"] + "/accounts",
         settings["username"], 
         settings["apikey"], 
-        params, 
-        debug=args.debug))
-    accounts += jData["accounts"]
-
-    page+=1
-    lastpage = jData["lastPage"]
+        {}, 
+        prefetch=args.prefetch,
+        cache=args.cache,
+        debug=args.debug):
+    accounts.write_all(jData["accounts"])
 
 # Dump the result
 #
-print(json.dumps(accounts, indent=4))
+accounts.close()
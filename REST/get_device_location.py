@@ -48,6 +48,9 @@ parser.add_argument("-l", "--list", help="File with ICCIDs", type=str)
 parser.add_argument("-f", "--fromDate", type=str, help='Location history from yyyy-MM-ddTHH:mm:ssZ')
 parser.add_argument("-t", "--toDate", type=str, help='Location history until yyyy-MM-ddTHH:mm:ssZ')
 parser.add_argument("-g", "--google", help="Use Google's geolocation API", action='store_true' )
+parser.add_argument("-p", "--prefetch", type=int, default=0, help="Number of pages to request ahead in parallel")
+parser.add_argument("--jsonl", help="Stream the records as JSON lines while they are received", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
@@ -66,6 +69,7 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 if args.google:
     google_settings = functions.load_site_settings("google")
 
@@ -80,57 +84,48 @@ if args.toDate != None:
     print("  until ", args.toDate, file=sys.stderr)
     params["toDate"] = args.toDate
 
-locations=[]
+# Enrich a location with data from Google's geolocation API
+#
+def enrich_location(location):
+    cell={}
+    cell["cellId"]            = location["cellId"]
+    cell["locationAreaCode"]  = location["cellLac"]
+    cell["mobileCountryCode"] = location["servingMcc"]
+    cell["mobileNetworkCode"] = location["servingMnc"]
+    celllist=[]
+    celllist.append(cell)
+    jsondata = {"cellTowers": celllist}
+
+    jGoogleData = json.loads(functions.get_data(
+        google_settings["resturl"] + "/geolocate",
+        '',
+        '',
+        {"key": google_settings["apikey"]},
+        method="post",
+        jsondata=jsondata,
+        debug=args.debug))
+    
+    location["google_latitude"] = jGoogleData["location"]["lat"]
+    location["google_longitude"] = jGoogleData["location"]["lng"]
+
+locations = functions.RecordWriter(jsonl=args.jsonl)
 
 for iccid in iccids:
 
     print("ICCID: ", iccid, file=sys.stderr)
 
-    page = 1
-    lastpage = False
-
-    while not lastpage:
-
-        print(f"  Requesting page {page}", file=sys.stderr)
-
-        params["pageNumber"] = page
-
-        jData = json.loads(functions.get_data(
+    for page, jData in functions.get_pages(
             settings["resturl"] + "/devices/" + iccid + "/locationHistory",
             settings["username"], 
             settings["apikey"], 
             params, 
-            debug=args.debug))
+            prefetch=args.prefetch,
+            debug=args.debug):
         
         for location in jData["simLocations"]:
-            locations.append(location)
-
-        page+=1
-        lastpage = jData["lastPage"]
-
-# Enrich the locations with data from Google's geolocation API
-#
-if args.google:
-    for location in locations:
-        cell={}
-        cell["cellId"]            = location["cellId"]
-        cell["locationAreaCode"]  = location["cellLac"]
-        cell["mobileCountryCode"] = location["servingMcc"]
-        cell["mobileNetworkCode"] = location["servingMnc"]
-        celllist=[]
-        celllist.append(cell)
-        jsondata = {"cellTowers": celllist}
-
-        jGoogleData = json.loads(functions.get_data(
-            google_settings["resturl"] + "/geolocate",
-            '',
-            '',
-            {"key": google_settings["apikey"]},
-            method="post",
-            jsondata=jsondata,
-            debug=args.debug))
-        
-        location["google_latitude"] = jGoogleData["location"]["lat"]
-        location["google_longitude"] = jGoogleData["location"]["lng"]
+            if args.google:
+                enrich_location(location)
+            locations.write(location)
+        locations.flush()
 
-print(json.dumps(locations, indent=4))
+locations.close()
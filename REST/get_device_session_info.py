@@ -46,6 +46,9 @@ parser.add_argument("site", help="Name of the site as specified in settings.yaml
 parser.add_argument("-i", "--iccid", help="Device ICCID", type=str, action='append')
 parser.add_argument("-l", "--list", help="File with ICCIDs", type=str)
 parser.add_argument("-f", "--fields", type=str, default='', help='Fields to print from JSON')
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of requests to run in parallel")
+parser.add_argument("-e", "--errors", type=str, help="Continue after failed requests and write the failed ICCIDs to this CSV file")
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
@@ -70,21 +73,22 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
-alldevices=[]
-print(f"Processing {len(iccids)} ICCIDs", file=sys.stderr)
-for iccid in iccids:
+print(f"Processing {len(iccids)} ICCIDs with concurrency {args.concurrency}", file=sys.stderr)
 
-    print("Getting session info for ICCID", iccid, file=sys.stderr)
-
-    jData = json.loads(functions.get_data(
+# Request the session info of a single ICCID
+#
+def get_session_info(iccid):
+    return json.loads(functions.get_data(
         settings["resturl"] + "/devices/" + iccid + "/sessionInfo" + fields,
         settings["username"], 
         settings["apikey"], 
         {}, 
-        debug=args.debug))
+        debug=args.debug,
+        bad_request="raise"))
 
-    alldevices.append(jData)
+alldevices = functions.run_bulk(iccids, get_session_info, args.concurrency, args.errors)
 
 # Dump the result
 #
@@ -32,6 +32,7 @@ import json
 import os
 import argparse
 import sys
+import tempfile
 
 # Import functions from parent directory
 #
@@ -46,38 +47,108 @@ parser = argparse.ArgumentParser(os.path.basename(__file__))
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
 parser.add_argument("-a", "--account", default='', help="ID of the account", type=str)
 parser.add_argument("-m", "--modified", default='2000-01-01T00:00:00+00:00', help="Modified since, e.g. 2000-01-01T00:00:00+00:00", type=str)
+parser.add_argument("-p", "--prefetch", type=int, default=0, help="Number of pages to request ahead in parallel")
+parser.add_argument("--jsonl", help="Stream the records as JSON lines while they are received", action='store_true' )
+parser.add_argument("-s", "--sharded", help="Crawl the devices of all accounts in parallel, one account per worker", action='store_true' )
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of accounts to crawl in parallel with --sharded")
+parser.add_argument("-o", "--output", type=str, help="Write the records to this file and keep a checkpoint to resume the crawl")
+parser.add_argument("-r", "--resume", help="Resume an interrupted crawl from the checkpoint of the output file", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
-devices=[]
-page = 1
-lastpage = False
+if args.resume and args.output == None:
+    sys.exit("Resuming a crawl requires an output file (option -o)")
+if args.sharded and args.account != '':
+    sys.exit("A sharded crawl is only possible for all accounts (without option -a)")
+if args.sharded and args.resume:
+    sys.exit("A sharded crawl can't be resumed")
 
-while not lastpage:
+url = settings["resturl"] + "/devices"
 
-    print(f"Requesting page {page}", file=sys.stderr)
+params={
+    "accountId": args.account,
+    "modifiedSince": args.modified
+}
 
-    params={
-        "accountId": args.account,
-        "pageNumber": page,
-        "modifiedSince": args.modified
-    }
-
-    jData = json.loads(functions.get_data(
-        settings["resturl"] + "/devices",
-        settings["username"], 
-        settings["apikey"], 
-        params, 
-        debug=args.debug))
-    devices += jData["devices"]
-
-    page+=1
-    lastpage = jData["lastPage"]
+# Crawl all pages of a single account and return its devices as JSON lines
+# in a temporary file, so that accounts that are waiting to be written
+# don't keep their devices in memory
+#
+def crawl_account(account):
+    print(f"Requesting devices of account {account}", file=sys.stderr)
+    accountdevices = tempfile.TemporaryFile("w+", encoding="utf-8")
+    try:
+        for page, jData in functions.get_pages(
+                url,
+                settings["username"], 
+                settings["apikey"], 
+                {"accountId": account, "modifiedSince": args.modified}, 
+                debug=args.debug):
+            for device in jData["devices"]:
+                accountdevices.write(json.dumps(device) + "\n")
+    except BaseException:
+        accountdevices.close()
+        raise
+    accountdevices.seek(0)
+    return accountdevices
+
+# Write to the output file with a checkpoint after each page if requested
+#
+query = {"url": url, "params": params}
+startpage = 1
+if args.output != None and args.sharded:
+    devices = functions.RecordWriter(open(args.output, "w"), args.jsonl)
+elif args.output != None:
+    devices, startpage = functions.open_checkpointed_output(args.output, query, args.jsonl, args.resume)
+else:
+    devices = functions.RecordWriter(jsonl=args.jsonl)
+
+if args.sharded:
+
+    # Enumerate the accounts, then crawl them with a pool of workers that
+    # each request one page at a time; the devices are written in the
+    # order of the accounts as soon as an account is complete, and only a
+    # few accounts are crawled ahead of the one being written
+    #
+    accounts = []
+    for page, jData in functions.get_pages(
+            settings["resturl"] + "/accounts",
+            settings["username"], 
+            settings["apikey"], 
+            {}, 
+            prefetch=args.prefetch,
+            debug=args.debug):
+        accounts += [str(account["accountId"]) for account in jData["accounts"]]
+
+    print(f"Crawling {len(accounts)} accounts with concurrency {args.concurrency}", file=sys.stderr)
+
+    for account, accountdevices, error in functions.fan_out(accounts, crawl_account, args.concurrency):
+        if error != None:
+            raise error
+        with accountdevices:
+            devices.write_all(json.loads(line) for line in accountdevices)
+
+else:
+    for page, jData in functions.get_pages(
+            url,
+            settings["username"], 
+            settings["apikey"], 
+            params, 
+            prefetch=args.prefetch,
+            start_page=startpage,
+            debug=args.debug):
+        devices.write_all(jData["devices"])
+        if args.output != None:
+            functions.save_checkpoint(args.output, query, page, devices)
 
 # Dump the result
 #
-print(json.dumps(devices, indent=4))
+devices.close()
+if args.output != None and not args.sharded:
+    functions.remove_checkpoint(args.output)
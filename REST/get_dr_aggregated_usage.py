@@ -52,14 +52,21 @@ parser.add_argument("-e", "--enddate", type=str, help='End date (YYYYMMDD)')
 parser.add_argument("-b", "--billingcycle", type=str, help='Billing cycle (YYYYMM)')
 parser.add_argument("-g", "--groupby", type=str, help='One or more of carrier,country,rate plan,rating zone, separated by comma')
 parser.add_argument("-m", "--metrics", type=str, help='Usage metric (one or more of data,voice,sms,vmo,vmt,smo,smt, separated by comma')
+parser.add_argument("--jsonl", help="Stream the records as JSON lines while they are received", action='store_true' )
+parser.add_argument("-o", "--output", type=str, help="Write the records to this file and keep a checkpoint to resume the crawl")
+parser.add_argument("-r", "--resume", help="Resume an interrupted crawl from the checkpoint of the output file", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
+
+if args.resume and args.output == None:
+    sys.exit("Resuming a crawl requires an output file (option -o)")
 
-records=[]
 page = 1
 lastpage = False
 
@@ -96,6 +103,14 @@ elif args.account:
 
 url += "/usage"
 
+# Write to the output file with a checkpoint after each page if requested
+#
+query = {"url": url, "params": {key: value for key, value in params.items() if key != "page_number"}}
+if args.output != None:
+    records, page = functions.open_checkpointed_output(args.output, query, args.jsonl, args.resume)
+else:
+    records = functions.RecordWriter(jsonl=args.jsonl)
+
 while not lastpage:
 
     print(f"{datetime.datetime.now()}: Requesting page {page}", file=sys.stderr)
@@ -122,14 +137,19 @@ while not lastpage:
                 record[element["metricType"]+"_count"] = element["count"]
             record.pop("metric_data",None)
 
-            records.append(record)
+            records.write(record)
 
     except Exception as e:
         print (e)
         sys.exit(json.dumps(jData, indent=4))
+    records.flush()
+    if args.output != None:
+        functions.save_checkpoint(args.output, query, page, records)
     page+=1
     lastpage = page > jData["body"]["metaData"]["total_pages"]
 
 # Dump the result
 #
-print(json.dumps(records, indent=4))
+records.close()
+if args.output != None:
+    functions.remove_checkpoint(args.output)
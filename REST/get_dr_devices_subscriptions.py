@@ -49,14 +49,17 @@ parser.add_argument("-a", "--account", default='', help="ID of the account", typ
 parser.add_argument("-s", "--startdate", type=str, help='Start date (YYYYMMDD)')
 parser.add_argument("-e", "--enddate", type=str, help='End date (YYYYMMDD)')
 parser.add_argument("-b", "--billingcycle", type=str, help='Billing cycle (YYYYMM)')
+parser.add_argument("--jsonl", help="Stream the records as JSON lines while they are received", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
-devices=[]
+devices = functions.RecordWriter(jsonl=args.jsonl)
 page = 1
 lastpage = False
 
@@ -99,12 +102,13 @@ while not lastpage:
     try:
         for device in jData["body"]["data"]:
             device["period_ending_str"] = strftime('%Y-%m-%d', localtime(device["period_ending"]/1000))
-            devices.append(device) 
+            devices.write(device) 
     except:
         sys.exit(jData)
+    devices.flush()
     page+=1
     lastpage = page > jData["body"]["meta"]["total_page"]
 
 # Dump the result
 #
-print(json.dumps(devices, indent=4))
+devices.close()
@@ -53,14 +53,17 @@ parser.add_argument("-b", "--billingcycle", type=str, help='Billing cycle (YYYYM
 parser.add_argument("-g", "--groupby", type=str, help='One or more of carrier, country, rate plan, rating zone, separated by comma')
 parser.add_argument("-m", "--metrics", type=str, help='Usage metric (one of data, voice, sms, vmo, vmt, smo,smt')
 parser.add_argument("-k", "--topk", type=str, help='Number of devices to show in Top K report')
+parser.add_argument("--jsonl", help="Stream the records as JSON lines while they are received", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
-records=[]
+records = functions.RecordWriter(jsonl=args.jsonl)
 page = 1
 lastpage = False
 
@@ -126,14 +129,15 @@ while not lastpage:
                 record[element["metricType"]+"_count"] = element["count"]
             record.pop("metric_data",None)
 
-            records.append(record)
+            records.write(record)
 
     except Exception as e:
         print (e)
         sys.exit(json.dumps(jData, indent=4))
+    records.flush()
     page+=1
     lastpage = page > jData["body"]["metaData"]["total_pages"]
 
 # Dump the result
 #
-print(json.dumps(records, indent=4))
+records.close()
@@ -28,7 +28,6 @@ __version__ = "1.0.0"
 __copyright__ = "Copyright (c) 2023 Cisco and/or its affiliates."
 __license__ = "Cisco Sample Code License, Version 1.1"
 
-import json
 import os
 import argparse
 import sys
@@ -45,12 +44,18 @@ parser = argparse.ArgumentParser(os.path.basename(__file__))
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
 parser.add_argument('-f', '--fields', type=str, default=',', help='Fields to print from JSON')
 parser.add_argument("-a", "--account", help="ID of the account", type=str)
+parser.add_argument("--no-cache", dest="cache", action='store_const', const="off", default="use", help="Do not use the response cache")
+parser.add_argument("--refresh", dest="cache", action='store_const', const="refresh", help="Refresh the response cache")
+parser.add_argument("-p", "--prefetch", type=int, default=0, help="Number of pages to request ahead in parallel")
+parser.add_argument("--jsonl", help="Stream the records as JSON lines while they are received", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 # Build the fields selector in case it was provided
 #
@@ -58,29 +63,22 @@ fields =''
 if args.fields != '':
     fields = '?fields=' + args.fields
 
-rateplans=[]
-page = 1
-lastpage = False
+rateplans = functions.RecordWriter(jsonl=args.jsonl)
+params={}
 
-while not lastpage:
+if args.account != None:
+    params["accountId"] = args.account
 
-    print(f"Requesting page {page}", file=sys.stderr)
-
-    params={"pageNumber": page}
-
-    if args.account != None:
-        params["accountId"] = args.account
-
-    jData = json.loads(functions.get_data(
+for page, jData in functions.get_pages(
         settings["resturl"] + "/rateplans" + fields,
         settings["username"], 
         settings["apikey"], 
         params, 
-        debug=args.debug))
-    rateplans += jData["ratePlans"]
-    page+=1
-    lastpage = jData["lastPage"]
+        prefetch=args.prefetch,
+        cache=args.cache,
+        debug=args.debug):
+    rateplans.write_all(jData["ratePlans"])
 
 # Dump the result
 #
-print(json.dumps(rateplans, indent=4))
+rateplans.close()
@@ -32,7 +32,6 @@ import json
 import os
 import argparse
 import sys
-import requests
 
 # Import functions from parent directory
 #
@@ -66,9 +65,9 @@ print(text, file=sys.stderr)
 
 # Send the API request
 #
-myResponse = requests.post(
-        settings["resturl"] + "/devices/" + args.iccid + "/smsMessages/",
-        auth=(settings["username"],settings["apikey"]),
+url = settings["resturl"] + "/devices/" + args.iccid + "/smsMessages/"
+myResponse = functions.get_session(url, settings["username"], settings["apikey"]).post(
+        url,
         json={"messageText": text})
 
 # For successful API call, response code will be 200 (OK)
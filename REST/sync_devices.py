@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+----------------------------------------------------------------------
+ Synchronize a local SQLite mirror of the devices via REST API
+----------------------------------------------------------------------
+
+Copyright (c) 2023 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+
+"""
+
+__author__ = "Christian Falckenberg"
+__email__ = "cfalcken@cisco.com"
+__version__ = "1.0.0"
+__copyright__ = "Copyright (c) 2023 Cisco and/or its affiliates."
+__license__ = "Cisco Sample Code License, Version 1.1"
+
+import json
+import os
+import argparse
+import sys
+import sqlite3
+import datetime
+
+# Import functions from parent directory
+#
+currdir = os.path.dirname(os.path.realpath(__file__))                       
+sys.path.append(os.path.join(currdir, os.pardir))
+import functions
+
+# Parse the command line to get the site name
+# Optionally, specify one or more account IDs to synchronize
+#
+parser = argparse.ArgumentParser(os.path.basename(__file__))
+parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
+parser.add_argument("-a", "--account", help="ID of the account (default: all accounts)", type=str, action='append')
+parser.add_argument("-b", "--database", type=str, help="SQLite database file of the mirror (default: <site>-devices.sqlite)")
+parser.add_argument("-m", "--modified", default='2000-01-01T00:00:00+00:00', help="Modified since for the first synchronization, e.g. 2000-01-01T00:00:00+00:00", type=str)
+parser.add_argument("-o", "--overlap", type=int, default=300, help="Seconds to overlap with the previous synchronization to allow for clock skew")
+parser.add_argument("-D", "--details", help="Also store the device details of changed devices", action='store_true' )
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of device detail requests to run in parallel")
+parser.add_argument("-p", "--prefetch", type=int, default=0, help="Number of pages to request ahead in parallel")
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
+parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
+args = parser.parse_args()
+
+# Load settings for the site
+#
+settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
+
+if args.account == None:
+    accounts = ['']
+else:
+    accounts = args.account
+
+if args.database == None:
+    args.database = args.site + "-devices.sqlite"
+
+# Open the mirror; the sync state holds the high-water mark per account,
+# with an empty account ID for all accounts
+#
+db = sqlite3.connect(args.database)
+db.execute("""CREATE TABLE IF NOT EXISTS devices (
+    iccid TEXT PRIMARY KEY,
+    accountId TEXT,
+    device TEXT,
+    details TEXT,
+    synced TEXT)""")
+db.execute("""CREATE TABLE IF NOT EXISTS sync_state (
+    accountId TEXT PRIMARY KEY,
+    modifiedSince TEXT)""")
+db.commit()
+
+# Request the details of a device
+#
+def get_details(iccid):
+    return functions.get_data(
+        settings["resturl"] + "/devices/" + iccid,
+        settings["username"], 
+        settings["apikey"], 
+        {}, 
+        debug=args.debug).decode("utf-8")
+
+for account in accounts:
+
+    row = db.execute("SELECT modifiedSince FROM sync_state WHERE accountId = ?", (account,)).fetchone()
+    if row != None:
+        since = row[0]
+    else:
+        since = args.modified
+
+    # The next synchronization starts from the time this one started,
+    # minus the overlap
+    #
+    started = datetime.datetime.now(datetime.timezone.utc)
+    nextsince = (started - datetime.timedelta(seconds=args.overlap)).strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+    print(f"Synchronizing devices of account '{account or 'All'}' modified since {since}", file=sys.stderr)
+
+    params={
+        "accountId": account,
+        "modifiedSince": since
+    }
+
+    changed = 0
+    for page, jData in functions.get_pages(
+            settings["resturl"] + "/devices",
+            settings["username"], 
+            settings["apikey"], 
+            params, 
+            prefetch=args.prefetch,
+            debug=args.debug):
+
+        devices = jData["devices"]
+
+        # Get the details of the changed devices if requested
+        #
+        details = [None] * len(devices)
+        if args.details and devices:
+            details = functions.run_bulk(
+                [device["iccid"] for device in devices],
+                get_details,
+                args.concurrency,
+                dedupe=False)
+
+        db.executemany("""INSERT INTO devices (iccid, accountId, device, details, synced)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(iccid) DO UPDATE SET
+                accountId = COALESCE(NULLIF(excluded.accountId, ''), devices.accountId),
+                device = excluded.device,
+                details = COALESCE(excluded.details, devices.details),
+                synced = excluded.synced""",
+            [(device["iccid"], account or json.loads(detail or '{}').get("accountId", ''), json.dumps(device), detail, started.isoformat()) for device, detail in zip(devices, details)])
+        db.commit()
+        changed += len(devices)
+
+    # Only move the high-water mark once all pages have been stored
+    #
+    db.execute("""INSERT INTO sync_state (accountId, modifiedSince) VALUES (?, ?)
+        ON CONFLICT(accountId) DO UPDATE SET modifiedSince = excluded.modifiedSince""", (account, nextsince))
+    db.commit()
+
+    print(f"Stored {changed} changed devices; next synchronization from {nextsince}", file=sys.stderr)
+
+total = db.execute("SELECT COUNT(*) FROM devices").fetchone()[0]
+print(f"Mirror {args.database} contains {total} devices", file=sys.stderr)
+db.close()
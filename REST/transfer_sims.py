@@ -51,6 +51,7 @@ parser.add_argument("-r", "--rateplan", help="Optional target rate plan name", t
 parser.add_argument("-c", "--commplan", help="Optional target comm plan name", type=str)
 parser.add_argument("-s", "--state", help="Optional target SIM state", type=str)
 parser.add_argument("-u", "--url", help="Optional call back URL", type=str)
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 parser.add_argument("-d", "--debug", help="Enable debug output", action='store_true' )
 args = parser.parse_args()
 
@@ -75,6 +76,7 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 # Build parameter
 #
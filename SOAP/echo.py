@@ -35,7 +35,6 @@ import os
 import logging
 import yaml
 import zeep
-from zeep import Client
 from errors import SoapError
 import traceback
 
@@ -53,11 +52,14 @@ logging.getLogger('zeep').setLevel(logging.ERROR)
 parser = argparse.ArgumentParser(os.path.basename(__file__))
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
 parser.add_argument("string", help="String to send for echo", type=str)
+parser.add_argument("--refresh-wsdl", help="Download the WSDL and schemas again instead of using the cache", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 args = parser.parse_args()
 
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 print("Sending echo request for ", args.string, file=sys.stderr)
 
@@ -68,11 +70,7 @@ version = '1'
 
 # Create a SOAP client
 #
-client = Client(url)
-
-# Set SOAP action in the header
-#
-client.transport.session.headers['SOAPAction'] = soap_action
+client = functions.get_soap_client(settings, url, soap_action, wsse=False, refresh=args.refresh_wsdl)
 
 # Call the EchoRequest method
 #
@@ -224,3 +224,13 @@ def SoapError(errno):
     }
 
     return errors.get(errno, "Unknown Error")
+
+# Errors that are transient, so that the call can be repeated after a while
+#
+def SoapErrorRetryable(errno):
+    retryable = {
+        "400101",   # License has exceeded the rate limit for API calls
+        "400300"    # System internal error
+    }
+
+    return errno in retryable
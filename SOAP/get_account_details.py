@@ -33,9 +33,7 @@ import sys
 import os
 import logging
 import zeep
-from zeep import Client
-from zeep.wsse.username import UsernameToken
-from errors import SoapError
+from errors import SoapError, SoapErrorRetryable
 
 # Import functions from parent directory
 #
@@ -52,6 +50,8 @@ parser = argparse.ArgumentParser(os.path.basename(__file__))
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
 parser.add_argument("-a", "--account", help="ID of the account", type=str, action='append')
 parser.add_argument("-f", "--accountfile", help="File with account IDs", type=str)
+parser.add_argument("--refresh-wsdl", help="Download the WSDL and schemas again instead of using the cache", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 args = parser.parse_args()
 
 # Get the list of account IDs
@@ -69,6 +69,7 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 url = settings["wsdlurl"] + '/Account.wsdl'
 soap_action = 'http://api.jasperwireless.com/ws/service/accounts/GetAccountDetails'
@@ -77,18 +78,14 @@ version = '1'
 
 # Create a SOAP client
 #
-client = Client(url, wsse=UsernameToken(settings["username"], settings["password"]))
-
-# Set SOAP action in the header
-#
-client.transport.session.headers['SOAPAction'] = soap_action
+client = functions.get_soap_client(settings, url, soap_action, refresh=args.refresh_wsdl)
 
 print("Getting account details", file=sys.stderr)
 
 # Call the GetAccountDetails method
 #
 try:
-    result = client.service.GetAccountDetails(
+    result = functions.soap_call(settings, SoapErrorRetryable, client.service.GetAccountDetails,
         messageId=messageId,
         version=version,
         licenseKey=settings["licensekey"],
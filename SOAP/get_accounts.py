@@ -33,9 +33,7 @@ import sys
 import os
 import logging
 import zeep
-from zeep import Client
-from zeep.wsse.username import UsernameToken
-from errors import SoapError
+from errors import SoapError, SoapErrorRetryable
 
 # Import functions from parent directory
 #
@@ -50,11 +48,14 @@ logging.getLogger('zeep').setLevel(logging.ERROR)
 #
 parser = argparse.ArgumentParser(os.path.basename(__file__))
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
+parser.add_argument("--refresh-wsdl", help="Download the WSDL and schemas again instead of using the cache", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 args = parser.parse_args()
 
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 url = settings["wsdlurl"] + '/Account.wsdl'
 soap_action = 'http://api.jasperwireless.com/ws/service/accounts/GetAccounts'
@@ -63,11 +64,7 @@ version = '1'
 
 # Create a SOAP client
 #
-client = Client(url, wsse=UsernameToken(settings["username"], settings["password"]))
-
-# Set SOAP action in the header
-#
-client.transport.session.headers['SOAPAction'] = soap_action
+client = functions.get_soap_client(settings, url, soap_action, refresh=args.refresh_wsdl)
 
 page = 1
 count = 0
@@ -80,7 +77,7 @@ while page < totalPages:
     # Call the GetTerminalDetails method
     #
     try:
-        result = client.service.GetAccounts(
+        result = functions.soap_call(settings, SoapErrorRetryable, client.service.GetAccounts,
             messageId=messageId, 
             version=version, 
             licenseKey=settings["licensekey"],
@@ -33,10 +33,10 @@ import sys
 import os
 import logging
 import zeep
+import requests
 import json
-from zeep import Client, helpers
-from zeep.wsse.username import UsernameToken
-from errors import SoapError
+import csv
+from errors import SoapError, SoapErrorRetryable
 
 # Import functions from parent directory
 #
@@ -55,6 +55,11 @@ parser = argparse.ArgumentParser(os.path.basename(__file__))
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
 parser.add_argument("-i", "--iccid", help="Device ICCID", type=str, action='append')
 parser.add_argument("-f", "--iccidfile", help="File with ICCIDs", type=str)
+parser.add_argument("-b", "--batchsize", type=int, default=50, help="Number of ICCIDs per request")
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of requests to run in parallel")
+parser.add_argument("-e", "--errors", type=str, help="Write the ICCIDs of failed batches to this CSV file")
+parser.add_argument("--refresh-wsdl", help="Download the WSDL and schemas again instead of using the cache", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 args = parser.parse_args()
 
 # Get the list of ICCIDs
@@ -72,6 +77,7 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 url = settings["wsdlurl"] + '/Terminal.wsdl'
 soap_action = 'http://api.jasperwireless.com/ws/service/terminal/GetTerminalDetails'
@@ -80,37 +86,47 @@ version = '1'
 
 # Create a SOAP client
 #
-client = Client(url, wsse=UsernameToken(settings["username"], settings["password"]))
-
-# Set SOAP action in the header
-#
-client.transport.session.headers['SOAPAction'] = soap_action
+client = functions.get_soap_client(settings, url, soap_action, refresh=args.refresh_wsdl)
 
 alldevices=[]
+failed=[]
 
-# Use a loop in case a large list of ICCDIs is given
+# Request the details of a batch of ICCIDs
+#
+def get_terminal_details(batch):
+    result = functions.soap_call(settings, SoapErrorRetryable, client.service.GetTerminalDetails,
+        messageId=messageId,
+        version=version,
+        licenseKey=settings["licensekey"],
+        iccids={"iccid": list(batch)}
+     )
+
+    # Convert the result
+    # 
+    return [functions.convert_zeep_object(record) for record in result.terminals["terminal"]]
+
+# Use batches in case a large list of ICCDIs is given, and send them in
+# parallel; a fault or a failed request only affects the ICCIDs of its own
+# batch, so that the results of the other batches are kept
 #
-for i in range(0, len(iccids), 50):
-    iccid_slice = iccids[i:i + 50]
-
-    # Call the GetTerminalDetails method
-    #
-    try:
-        result = client.service.GetTerminalDetails(
-            messageId=messageId,
-            version=version,
-            licenseKey=settings["licensekey"],
-            iccids={"iccid": iccid_slice}
-         )
-
-        # Convert the result
-        # 
-        for record in result.terminals["terminal"]:
-            terminal = functions.convert_zeep_object(record)  
-            alldevices.append(terminal)
-
-    except zeep.exceptions.Fault as fault:
-        print("Error", fault.message, ":", SoapError(fault.message), file=sys.stderr)
+batches = [tuple(iccids[i:i + args.batchsize]) for i in range(0, len(iccids), args.batchsize)]
+print(f"Requesting {len(iccids)} ICCIDs in {len(batches)} batches with concurrency {args.concurrency}", file=sys.stderr)
+
+for batch, terminals, error in functions.fan_out(batches, get_terminal_details, args.concurrency, dedupe=False, progress=10):
+    if isinstance(error, zeep.exceptions.Fault):
+        print("Error", error.message, ":", SoapError(error.message), f"for batch {batch[0]} - {batch[-1]}", file=sys.stderr)
+        failed += [[iccid, error.message, SoapError(error.message)] for iccid in batch]
+    elif isinstance(error, (zeep.exceptions.TransportError, requests.RequestException, functions.ControlCenterError)):
+        print("Error", error, f"for batch {batch[0]} - {batch[-1]}", file=sys.stderr)
+        failed += [[iccid, type(error).__name__, str(error)] for iccid in batch]
+    elif error != None:
+        raise error
+    else:
+        alldevices += terminals
+
+if args.errors != None:
+    with open(args.errors, "w", newline="") as errorfile:
+        csv.writer(errorfile).writerows(failed)
 
 # print to stdout
 json.dump(alldevices,sys.stdout, indent=4)
@@ -34,9 +34,7 @@ import os
 import logging
 import zeep
 import json
-from zeep import Client
-from zeep.wsse.username import UsernameToken
-from errors import SoapError
+from errors import SoapError, SoapErrorRetryable
 
 # Import functions from parent directory
 #
@@ -55,6 +53,9 @@ parser = argparse.ArgumentParser(os.path.basename(__file__))
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
 parser.add_argument("-i", "--iccid", help="Device ICCID", type=str, action='append')
 parser.add_argument("-f", "--iccidfile", help="File with ICCIDs", type=str)
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of requests to run in parallel")
+parser.add_argument("--refresh-wsdl", help="Download the WSDL and schemas again instead of using the cache", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 args = parser.parse_args()
 
 
@@ -73,6 +74,7 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 url         = settings["wsdlurl"] + '/Terminal.wsdl'
 soap_action = 'http://api.jasperwireless.com/ws/service/terminal/GetSessionInfo'
@@ -81,37 +83,37 @@ version     = '1'
 
 # Create a SOAP client
 #
-client = Client(url, wsse=UsernameToken(settings["username"], settings["password"]))
-
-# Set SOAP action in the header
-#
-client.transport.session.headers['SOAPAction'] = soap_action
+client = functions.get_soap_client(settings, url, soap_action, refresh=args.refresh_wsdl)
 
 # Call the GetTerminalDetails method
 #
 alldevices=[]
 
-for iccid in iccids:
-    try:
-        result = client.service.GetSessionInfo(
-            messageId=messageId, 
-            version=version, 
-            licenseKey=settings["licensekey"],
-            iccid=iccid
-        )
-
-        # Collect the result
-        #
-        if result.sessionInfo != None:
-            for record in result.sessionInfo["session"]:
-                terminal ={}
-                for key in record:
-                    terminal[key] = str(record[key])
-            
-            alldevices.append(terminal)
-
-    except zeep.exceptions.Fault as fault:
-        print("Error", fault.message, ":", SoapError(fault.message))
+# Request the session info of a single ICCID
+#
+def get_session_info(iccid):
+    result = functions.soap_call(settings, SoapErrorRetryable, client.service.GetSessionInfo,
+        messageId=messageId,
+        version=version,
+        licenseKey=settings["licensekey"],
+        iccid=iccid
+    )
+
+    terminal = None
+    if result.sessionInfo != None:
+        for record in result.sessionInfo["session"]:
+            terminal ={}
+            for key in record:
+                terminal[key] = str(record[key])
+    return terminal
+
+for iccid, terminal, error in functions.fan_out(iccids, get_session_info, args.concurrency):
+    if isinstance(error, zeep.exceptions.Fault):
+        print("Error", error.message, ":", SoapError(error.message))
+    elif error != None:
+        raise error
+    elif terminal != None:
+        alldevices.append(terminal)
 
 # print to stdout
 json.dump(alldevices,sys.stdout, indent=4)
@@ -33,9 +33,7 @@ import sys
 import os
 import logging
 import zeep
-from zeep import Client
-from zeep.wsse.username import UsernameToken
-from errors import SoapError
+from errors import SoapError, SoapErrorRetryable
 
 # Import functions from parent directory
 #
@@ -52,62 +50,99 @@ parser = argparse.ArgumentParser(os.path.basename(__file__))
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
 parser.add_argument("-a", "--account", default='', help="ID of the account", type=str)
 parser.add_argument("-m", "--modified", default='2000-01-01T00:00:00+00:00', help="Modified since, e.g. 2000-01-01T00:00:00+00:00", type=str)
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of pages to request in parallel")
+parser.add_argument("--raw", help="Parse the responses with lxml instead of zeep; faster and using less memory for large accounts", action='store_true' )
+parser.add_argument("--refresh-wsdl", help="Download the WSDL and schemas again instead of using the cache", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 args = parser.parse_args()
 
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 url         = settings["wsdlurl"] + '/Terminal.wsdl'
 soap_action = 'http://api.jasperwireless.com/ws/service/terminal/GetTerminalDetails'
+raw_action  = 'http://api.jasperwireless.com/ws/service/terminal/GetModifiedTerminals'
 messageId   = '123456'
 version     = '1'
 
+ICCID = functions.soap_tag("iccid")
+TOTALPAGES = functions.soap_tag("totalPages")
+
 # Create a SOAP client
 #
-client = Client(url, wsse=UsernameToken(settings["username"], settings["password"]))
+if not args.raw:
+    client = functions.get_soap_client(settings, url, soap_action, refresh=args.refresh_wsdl)
 
-# Set SOAP action in the header
+# Function to get the ICCIDs and the total number of pages for a page,
+# either with the zeep client or by parsing the raw response
 #
-client.transport.session.headers['SOAPAction'] = soap_action
-
-page = 1
-count = 0
-totalPages = 100
+def get_page(page):
+    if args.raw:
+        iccids = []
+        totalPages = 0
+        for element in functions.soap_iterparse(settings, "terminal", raw_action, "GetModifiedTerminals", {
+                "messageId": messageId,
+                "version": version,
+                "licenseKey": settings["licensekey"],
+                "accountId": args.account or None,
+                "since": args.modified,
+                "pageNumber": page
+            }, [ICCID, TOTALPAGES]):
+            if element.tag == ICCID:
+                iccids.append(element.text)
+            else:
+                totalPages = int(element.text)
+        return iccids, totalPages
+
+    if args.account == "":
+        result = client.service.GetModifiedTerminals(
+            messageId=messageId, 
+            version=version, 
+            licenseKey=settings["licensekey"],
+            since=args.modified,
+            pageNumber=page
+        )
+    else:
+        result = client.service.GetModifiedTerminals(
+            messageId=messageId, 
+            version=version, 
+            licenseKey=settings["licensekey"],
+            accountId=args.account,
+            since=args.modified,
+            pageNumber=page
+        )
+    # An empty page has no iccids element at all
+    #
+    if result.iccids is None:
+        return [], result.totalPages
+    return result.iccids["iccid"], result.totalPages
 
 print("Getting all devices", file=sys.stderr)
 
-while page < totalPages:
+# Call the GetModifiedTerminals method for the first page, which returns
+# the total number of pages
+#
+try:
+    iccids, totalPages = functions.soap_call(settings, SoapErrorRetryable, get_page, 1)
+except zeep.exceptions.Fault as fault:
+    print("Error", fault.message, ":", SoapError(fault.message))
+    iccids, totalPages = [], 0
 
-    # Call the GetTerminalDetails method
-    #
-    try:
-        if args.account == "":
-            result = client.service.GetModifiedTerminals(
-                messageId=messageId, 
-                version=version, 
-                licenseKey=settings["licensekey"],
-                since=args.modified,
-                pageNumber=page
-            )
-        else:
-            result = client.service.GetModifiedTerminals(
-                messageId=messageId, 
-                version=version, 
-                licenseKey=settings["licensekey"],
-                accountId=args.account,
-                since=args.modified,
-                pageNumber=page
-        )
+for iccid in iccids:
+    print (iccid)
 
-    except zeep.exceptions.Fault as fault:
-        print("Error", fault.message, ":", SoapError(fault.message))
+# The remaining pages are independent of each other and are requested in
+# parallel; the ICCIDs are still printed in page order
+#
+for page, result, error in functions.fan_out(range(2, totalPages + 1), lambda page: functions.soap_call(settings, SoapErrorRetryable, get_page, page), args.concurrency, dedupe=False, progress=0):
+    if error is not None:
+        if not isinstance(error, zeep.exceptions.Fault):
+            raise error
+        print("Error", error.message, ":", SoapError(error.message))
         break
 
-    for iccid in result.iccids["iccid"]:
+    print(f"Received page {page} of {totalPages}", file=sys.stderr)
+    for iccid in result[0]:
         print (iccid)
-
-    totalPages = result.totalPages
-    page += 1
-    if page < totalPages:
-        print(f"Requesting page {page} of {totalPages}", file=sys.stderr)
@@ -34,9 +34,8 @@ import os
 import logging
 import zeep
 import json
-from zeep import Client
-from zeep.wsse.username import UsernameToken
-from errors import SoapError
+import csv
+from errors import SoapError, SoapErrorRetryable
 
 # Import functions from parent directory
 #
@@ -54,6 +53,12 @@ parser.add_argument("site", help="Name of the site as specified in settings.yaml
 parser.add_argument("startdate", help="Cycle start date, e.g. 2023-01-01", type=str)
 parser.add_argument("-a", "--account", help="ID of the account", type=str, action='append')
 parser.add_argument("-f", "--accountfile", help="File with account IDs", type=str)
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of requests to run in parallel")
+parser.add_argument("-e", "--errors", type=str, help="Write the failed account IDs to this CSV file")
+parser.add_argument("--no-cache", dest="cache", action='store_const', const="off", default="use", help="Do not use the store of issued invoices")
+parser.add_argument("--refresh", dest="cache", action='store_const', const="refresh", help="Request all invoices again and update the store")
+parser.add_argument("--refresh-wsdl", help="Download the WSDL and schemas again instead of using the cache", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 args = parser.parse_args()
 
 # Get the list of account IDs
@@ -71,43 +76,76 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 url         = settings["wsdlurl"] + '/Billing.wsdl'
 soap_action = 'http://api.jasperwireless.com/ws/service/billing/GetInvoice'
 messageId   = '123456'
 version     = '1'
 
-# Create a SOAP client
+# Issued invoices don't change any more, so they are kept in the store and
+# only the invoices that aren't there yet are requested
 #
-client = Client(url, wsse=UsernameToken(settings["username"], settings["password"]))
+invoices = {}
+if args.cache == "use":
+    for account in dict.fromkeys(accounts):
+        invoice = functions.store_load(url, "invoices", [args.site, account, args.startdate])
+        if invoice is not None:
+            invoices[account] = invoice
+
+missing = [account for account in dict.fromkeys(accounts) if account not in invoices]
+print(f"Found {len(invoices)} invoices in the store; requesting {len(missing)}", file=sys.stderr)
 
-# Set SOAP action in the header
+# Create a SOAP client
 #
-client.transport.session.headers['SOAPAction'] = soap_action
+if missing:
+    client = functions.get_soap_client(settings, url, soap_action, refresh=args.refresh_wsdl)
 
-# Call the GetInvoice method
+# Call the GetInvoice method for an account and store the invoice
 #
-allinvoices=[]
+def get_invoice(account):
+    print("Getting invoice for account ID", account, file=sys.stderr)
 
-for account in accounts:
+    result = functions.soap_call(settings, SoapErrorRetryable, client.service.GetInvoice,
+        messageId=messageId,
+        version=version,
+        licenseKey=settings["licensekey"],
+        accountId=account,
+        cycleStartDate=args.startdate,
+    )
+
+    # Keep only the invoice, without the fields that describe the call, so
+    # that the same invoice is always stored with the same content
+    #
+    invoice = functions.convert_zeep_object(result)
+    for field in ["messageId", "correlationId", "version", "build", "timestamp"]:
+        invoice.pop(field, None)
+
+    if args.cache != "off":
+        functions.store_save(url, "invoices", [args.site, account, args.startdate], invoice)
+    return invoice
+
+# Request the missing invoices in parallel; a fault (e.g. for an invoice
+# that hasn't been issued yet) only affects its own account
+#
+failed = []
+
+for account, invoice, error in functions.fan_out(missing, get_invoice, args.concurrency):
+    if isinstance(error, zeep.exceptions.Fault):
+        print("Error", error.message, ":", SoapError(error.message), f"for account ID {account}", file=sys.stderr)
+        failed.append([account, error.message, SoapError(error.message)])
+    elif error != None:
+        raise error
+    else:
+        invoices[account] = invoice
 
-    print("Getting invoice for account ID", account, file=sys.stderr)
+if args.errors != None:
+    with open(args.errors, "w", newline="") as errorfile:
+        csv.writer(errorfile).writerows(failed)
 
-    try:
-        result = client.service.GetInvoice(
-            messageId=messageId,
-            version=version,
-            licenseKey=settings["licensekey"],
-            accountId=account,
-            cycleStartDate=args.startdate,
-        )
-
-        # Collect the result
-        #
-        allinvoices.append(functions.convert_zeep_object(result))
-        
-    except zeep.exceptions.Fault as fault:
-        print("Error", fault.message, ":", SoapError(fault.message))
+# Collect the invoices in the order of the accounts
+#
+allinvoices = [invoices[account] for account in dict.fromkeys(accounts) if account in invoices]
 
 # print to stdout
 json.dump(allinvoices,sys.stdout, indent=4)
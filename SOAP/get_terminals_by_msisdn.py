@@ -32,10 +32,10 @@ import argparse
 import sys
 import os
 import logging
+import sqlite3
+import time
 import zeep
-from zeep import Client
-from zeep.wsse.username import UsernameToken
-from errors import SoapError
+from errors import SoapError, SoapErrorRetryable
 
 # Import functions from parent directory
 #
@@ -48,11 +48,20 @@ logging.getLogger('zeep').setLevel(logging.ERROR)
 
 # Parse the command line
 #
-parser = argparse.ArgumentParser(os.path.basename(__file__))
+parser = argparse.ArgumentParser(os.path.basename(__file__), description="Print the device records of MSISDNs; with --iccid-only print 'msisdn,iccid', answered from a local index where possible")
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
 parser.add_argument("-a", "--account", default='', help="ID of the account", type=str)
 parser.add_argument("-m", "--msisdn", help="Device MSISDN", type=str, action='append')
 parser.add_argument("-f", "--file", help="File with MSISDNs", type=str)
+parser.add_argument("-b", "--batchsize", type=int, default=50, help="Number of MSISDNs per request")
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of requests to run in parallel")
+parser.add_argument("--iccid-only", help="Print 'msisdn,iccid' instead of the device records, and answer MSISDNs from the index where possible", action='store_true' )
+parser.add_argument("-i", "--index", type=str, help="SQLite database file of the MSISDN to ICCID index (default: <site>-msisdns.sqlite)")
+parser.add_argument("-t", "--ttl", type=float, default=30, help="Days to answer an MSISDN from the index before requesting it again")
+parser.add_argument("--no-cache", dest="cache", action='store_const', const="off", default="use", help="Do not use the index")
+parser.add_argument("--refresh", dest="cache", action='store_const', const="refresh", help="Request all MSISDNs again and update the index")
+parser.add_argument("--refresh-wsdl", help="Download the WSDL and schemas again instead of using the cache", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 args = parser.parse_args()
 
 # Get the list of ICCIDs
@@ -69,36 +78,92 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 url         = settings["wsdlurl"] + '/Terminal.wsdl'
 soap_action = 'http://api.jasperwireless.com/ws/service/terminal/GetTerminalsByMsisdn'
 messageId   = '123456'
 version     = '1'
 
-# Create a SOAP client
-#
-client = Client(url, wsse=UsernameToken(settings["username"], settings["password"]))
+if args.index == None:
+    args.index = args.site + "-msisdns.sqlite"
 
-# Set SOAP action in the header
+# Open the index of MSISDNs that were resolved before
 #
-client.transport.session.headers['SOAPAction'] = soap_action
+if args.cache != "off":
+    db = sqlite3.connect(args.index)
+    db.execute("""CREATE TABLE IF NOT EXISTS msisdns (
+        msisdn TEXT PRIMARY KEY,
+        iccid TEXT,
+        resolved REAL)""")
+    db.commit()
+
+# Look up the MSISDNs in the index; only the others are requested. The
+# index only has the ICCIDs, so it is only used with --iccid-only
+#
+iccids = {}
+terminals = {}
+if args.cache == "use" and args.iccid_only:
+    oldest = time.time() - args.ttl * 24 * 3600
+    for msisdn in dict.fromkeys(msisdns):
+        row = db.execute("SELECT iccid FROM msisdns WHERE msisdn = ? AND resolved >= ?", (msisdn, oldest)).fetchone()
+        if row != None:
+            iccids[msisdn] = row[0]
+
+missing = [msisdn for msisdn in dict.fromkeys(msisdns) if msisdn not in iccids]
+print(f"Found {len(iccids)} MSISDNs in the index; requesting {len(missing)}", file=sys.stderr)
 
-print("Getting all devices", file=sys.stderr)
+# Create a SOAP client
+#
+if missing:
+    client = functions.get_soap_client(settings, url, soap_action, refresh=args.refresh_wsdl)
 
-# Call the GetTerminalByMsisdn method
+# Request the devices of a batch of MSISDNs
 #
-try:
-    result = client.service.GetTerminalsByMsisdn(
+def get_terminals(batch):
+    result = functions.soap_call(settings, SoapErrorRetryable, client.service.GetTerminalsByMsisdn,
         messageId=messageId, 
         version=version, 
         licenseKey=settings["licensekey"],
-        msisdns=msisdns
+        msisdns={"msisdn": list(batch)}
     )
 
-except zeep.exceptions.Fault as fault:
-    print("Error", fault.message, ":", SoapError(fault.message))
-
-for terminal in result.terminals["terminal"]:
-    print (terminal)
+    # An empty result has no terminals element at all
+    #
+    if result.terminals is None:
+        return []
+    return result.terminals["terminal"]
 
- 
\ No newline at end of file
+# Use batches of at most the number of MSISDNs the API accepts per call,
+# and send them in parallel; a fault only affects the MSISDNs of its own
+# batch. The devices found are added to the index
+#
+batches = [tuple(missing[i:i + args.batchsize]) for i in range(0, len(missing), args.batchsize)]
+
+for batch, result, error in functions.fan_out(batches, get_terminals, args.concurrency, dedupe=False, progress=10):
+    if isinstance(error, zeep.exceptions.Fault):
+        print("Error", error.message, ":", SoapError(error.message), f"for batch {batch[0]} - {batch[-1]}", file=sys.stderr)
+        continue
+    elif error != None:
+        raise error
+
+    for terminal in result:
+        iccids[terminal.msisdn] = terminal.iccid
+        if not args.iccid_only:
+            terminals[terminal.msisdn] = terminal
+    if args.cache != "off":
+        db.executemany("""INSERT INTO msisdns (msisdn, iccid, resolved) VALUES (?, ?, ?)
+            ON CONFLICT(msisdn) DO UPDATE SET iccid = excluded.iccid, resolved = excluded.resolved""",
+            [(terminal.msisdn, terminal.iccid, time.time()) for terminal in result])
+        db.commit()
+
+# Print the ICCID or the device record of each MSISDN in the order of the
+# input
+#
+for msisdn in dict.fromkeys(msisdns):
+    if not args.iccid_only and msisdn in terminals:
+        print(terminals[msisdn])
+    elif args.iccid_only and msisdn in iccids:
+        print(f"{msisdn},{iccids[msisdn]}")
+    else:
+        print(f"No device found for MSISDN {msisdn}", file=sys.stderr)
@@ -32,10 +32,9 @@ import argparse
 import sys
 import os
 import logging
+import threading
 import zeep
-from zeep import Client
-from zeep.wsse.username import UsernameToken
-from errors import SoapError
+from errors import SoapError, SoapErrorRetryable
 
 # Import functions from parent directory
 #
@@ -54,6 +53,10 @@ parser.add_argument("-a", "--account", help="ID of the account", type=str, actio
 parser.add_argument("-f", "--accountfile", help="File with account IDs", type=str)
 parser.add_argument("-m", "--modified", default='2000-01-01T00:00:00+00:00', help="Modified since, e.g. 2000-01-01T00:00:00+00:00", type=str)
 parser.add_argument("-s", "--state", default='', help="SIM state", type=str)
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of accounts and pages to request in parallel")
+parser.add_argument("--raw", help="Parse the responses with lxml instead of zeep; faster and using less memory for large accounts", action='store_true' )
+parser.add_argument("--refresh-wsdl", help="Download the WSDL and schemas again instead of using the cache", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 args = parser.parse_args()
 
 # Get the list of account IDs
@@ -70,102 +73,126 @@ else:
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 url         = settings["wsdlurl"] + '/Terminal.wsdl'
 soap_action = 'http://api.jasperwireless.com/ws/service/terminal/GetTerminalDetails'
+raw_action  = 'http://api.jasperwireless.com/ws/service/terminal/GetModifiedTerminals'
 messageId   = '123456'
 version     = '1'
 
-# Create a SOAP client
-#
-client = Client(url, wsse=UsernameToken(settings["username"], settings["password"]))
+ICCID = functions.soap_tag("iccid")
+TOTALPAGES = functions.soap_tag("totalPages")
 
-# Set SOAP action in the header
+# Create a SOAP client
 #
-client.transport.session.headers['SOAPAction'] = soap_action
-
-page = 1
-count = 0
-totalPages = 100
+if not args.raw:
+    client = functions.get_soap_client(settings, url, soap_action, refresh=args.refresh_wsdl)
 
 if args.state !="":
     state = args.state
 else:
     state ="UNKNOWN"
 
-allinvoices=[]
+# Function to get the number of devices on a page of an account and the
+# total number of pages, either with the zeep client or by parsing the raw
+# response, in which case the ICCIDs are only counted
+#
+def get_page(account, page):
+    if args.raw:
+        devices = 0
+        totalPages = 0
+        for element in functions.soap_iterparse(settings, "terminal", raw_action, "GetModifiedTerminals", {
+                "messageId": messageId,
+                "version": version,
+                "licenseKey": settings["licensekey"],
+                "accountId": None if account == "All" else account,
+                "since": args.modified,
+                "simState": state,
+                "pageNumber": page
+            }, [ICCID, TOTALPAGES]):
+            if element.tag == ICCID:
+                devices += 1
+            else:
+                totalPages = int(element.text)
+        return devices, totalPages
+
+    if account == "All":
+        result = client.service.GetModifiedTerminals(
+            messageId=messageId, 
+            version=version, 
+            licenseKey=settings["licensekey"],
+            since=args.modified,
+            simState=state,
+            pageNumber=page
+        )
+    else:
+        result = client.service.GetModifiedTerminals(
+            messageId=messageId, 
+            version=version, 
+            licenseKey=settings["licensekey"],
+            accountId=account,
+            since=args.modified,
+            simState=state,
+            pageNumber=page
+        )
+    # An empty page has no iccids element at all
+    #
+    if result.iccids is None:
+        return 0, result.totalPages
+    return len(result.iccids["iccid"]), result.totalPages
+
+# Limit the requests in flight to the concurrency, for all accounts together;
+# the accounts and the pages of an account that is counted page by page are
+# requested by separate pools of workers
+#
+inflight = threading.BoundedSemaphore(args.concurrency)
 
-for account in accounts:
+def request_page(account, page):
+    with inflight:
+        return functions.soap_call(settings, SoapErrorRetryable, get_page, account, page)
 
+# Function to count the devices of an account. All pages but the last one
+# are full, so the total is exact after probing the first and the last page.
+# If the number of pages changed in between or the last page doesn't fit,
+# all pages are counted instead. Only if the API refuses to return the
+# last page (error 10001) the total is estimated by rounding up to full pages
+#
+def count_devices(account):
     print(f"Getting device totals for account ID {account}", file=sys.stderr)
 
-    # Call the GetTerminalDetails method
-    #
-    print("Requesting devices from first page", file=sys.stderr)
+    devices, totalPages = request_page(account, 1)
+    if totalPages <= 1:
+        return devices, "exact"
 
     try:
-        if account == "All":
-            result = client.service.GetModifiedTerminals(
-                messageId=messageId, 
-                version=version, 
-                licenseKey=settings["licensekey"],
-                since=args.modified,
-                simState=state,
-                pageNumber=1
-            )
-        else:
-            result = client.service.GetModifiedTerminals(
-                messageId=messageId, 
-                version=version, 
-                licenseKey=settings["licensekey"],
-                accountId=account,
-                since=args.modified,
-                simState=state,
-                pageNumber=1
-            )
-
+        lastdevices, lastTotalPages = request_page(account, totalPages)
     except zeep.exceptions.Fault as fault:
-        print("Error", fault.message, ":", SoapError(fault.message))
-
-    devices = len(result.iccids["iccid"])
-    totalPages = result.totalPages
-
-    # Repeat the request for the last page if there are more
-    #
-    if totalPages > 100:
-        print(f"Found more than hundred pages ({totalPages})", file=sys.stderr)
-        print(f"Estimating number of devices by rounding up to full pages", file=sys.stderr)
-
-        print (f"{account},{devices*totalPages}")
-
-    elif totalPages >0:
-
-        print(f"Found {totalPages} pages; requesting devices from last page", file=sys.stderr)
- 
-        try:
-            if account == "All":
-                result = client.service.GetModifiedTerminals(
-                    messageId=messageId, 
-                    version=version, 
-                    licenseKey=settings["licensekey"],
-                    since=args.modified,
-                    simState=state,
-                    pageNumber=totalPages
-                )
-            else:
-                result = client.service.GetModifiedTerminals(
-                    messageId=messageId, 
-                    version=version, 
-                    licenseKey=settings["licensekey"],
-                    accountId=account,
-                    since=args.modified,
-                    simState=state,
-                    pageNumber=totalPages
-            )
-        except zeep.exceptions.Fault as fault:
-            print("Error", fault.message, ":", SoapError(fault.message))
-
-        print (f"{account},{devices*(totalPages-1)+len(result.iccids['iccid'])}")
-
-    else:
-        print (f"{account},{devices}")
+        if fault.message != "10001":
+            raise
+        print(f"Account ID {account} has too many pages ({totalPages}); estimating number of devices by rounding up to full pages", file=sys.stderr)
+        return devices * totalPages, "estimated"
+
+    if lastTotalPages == totalPages and 0 < lastdevices <= devices:
+        return devices * (totalPages - 1) + lastdevices, "exact"
+
+    print(f"Pages of account ID {account} changed while probing; counting all {lastTotalPages} pages", file=sys.stderr)
+    total = 0
+    for page, result, error in functions.fan_out(range(1, lastTotalPages + 1), lambda page: request_page(account, page), args.concurrency, dedupe=False, progress=0):
+        if error is not None:
+            raise error
+        total += result[0]
+    return total, "exact"
+
+# Count the devices of the accounts in parallel and print the totals in the
+# order of the accounts
+#
+for account, result, error in functions.fan_out(accounts, count_devices, args.concurrency):
+    if error is not None:
+        if not isinstance(error, zeep.exceptions.Fault):
+            raise error
+        print(f"Error for account ID {account}", error.message, ":", SoapError(error.message), file=sys.stderr)
+        continue
+
+    devices, accuracy = result
+    print (f"{account},{devices},{accuracy}")
@@ -33,11 +33,14 @@ import sys
 import os
 import logging
 import zeep
-import json
 import datetime
-from zeep import Client
-from zeep.wsse.username import UsernameToken
-from errors import SoapError
+import decimal
+import heapq
+import json
+import tempfile
+import calendar
+import csv
+from errors import SoapError, SoapErrorRetryable
 
 # Import functions from parent directory
 #
@@ -52,85 +55,324 @@ logging.getLogger('zeep').setLevel(logging.ERROR)
 #
 parser = argparse.ArgumentParser(os.path.basename(__file__))
 parser.add_argument("site", help="Name of the site as specified in settings.yaml", type=str)
-parser.add_argument("iccid", help="Device ICCID", type=str)
+parser.add_argument("iccid", help="Device ICCID", type=str, nargs='?')
 parser.add_argument("startdate", help="Cycle start date, e.g. 2023-01-01", type=str)
+parser.add_argument("-f", "--iccidfile", help="File with ICCIDs", type=str)
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of devices to request in parallel")
+parser.add_argument("-e", "--errors", type=str, help="Write the failed ICCIDs to this CSV file")
+parser.add_argument("-g", "--grace", type=int, default=7, help="Days after the end of a cycle until its usage is final and kept in the store")
+parser.add_argument("--no-cache", dest="cache", action='store_const', const="off", default="use", help="Do not use the store for closed cycles")
+parser.add_argument("--refresh", dest="cache", action='store_const', const="refresh", help="Request closed cycles again and update the store")
+parser.add_argument("-s", "--sessions", help="Summarize the records per session (records with the same session start time) and print each session when it is complete", action='store_true' )
+parser.add_argument("-w", "--window", type=int, default=100, help="Number of sessions kept open for late records when summarizing sessions")
+parser.add_argument("--jsonl", help="Print the records as JSON lines", action='store_true' )
+parser.add_argument("--raw", help="Parse the responses with lxml instead of zeep; faster and using less memory for devices with many records", action='store_true' )
+parser.add_argument("--refresh-wsdl", help="Download the WSDL and schemas again instead of using the cache", action='store_true' )
+parser.add_argument("--stats", nargs='?', const='-', help="Print request statistics at exit, or write them to a JSON or Prometheus (.prom) file")
 args = parser.parse_args()
 
+# Get the list of ICCIDs
+#
+if args.iccid == None:
+    if args.iccidfile == None:
+        print("Provide either an ICCID or use -f for a filename with ICCIDs")
+        exit()
+    else:
+        with open(args.iccidfile) as iccidfile:
+            iccids = iccidfile.read().splitlines()
+else:
+    iccids = [args.iccid]
+
+# The usage of a cycle doesn't change any more once the cycle has ended
+# and the grace period for late records has passed
+#
+cyclestart = datetime.date.fromisoformat(args.startdate)
+year, month = divmod(cyclestart.month, 12)
+year += cyclestart.year
+month += 1
+cycleend = cyclestart.replace(year=year, month=month, day=min(cyclestart.day, calendar.monthrange(year, month)[1]))
+closed = datetime.date.today() >= cycleend + datetime.timedelta(days=args.grace)
+
 # Load settings for the site
 #
 settings = functions.load_site_settings(args.site)
+functions.enable_stats(args.stats)
 
 url = settings["wsdlurl"] + '/Billing.wsdl'
 soap_action = 'http://api.jasperwireless.com/ws/service/billing/GetTerminalUsageDataDetails'
 messageId = '123456'
 version = '1'
 
+USAGEDETAIL = functions.soap_tag("usageDetail")
+DATAVOLUME = functions.soap_tag("dataVolume")
+DURATION = functions.soap_tag("duration")
+SESSIONSTARTTIME = functions.soap_tag("sessionStartTime")
+TOTALPAGES = functions.soap_tag("totalPages")
+
 # Create a SOAP client
 #
-client = Client(url, wsse=UsernameToken(settings["username"], settings["password"]))
+if not args.raw:
+    client = functions.get_soap_client(settings, url, soap_action, refresh=args.refresh_wsdl)
+
+# Function to get the usage records and the total number of pages for a
+# page, either with the zeep client or by parsing the raw response, in which
+# case only the fields needed here are extracted from each record
+#
+def get_page(iccid, page):
+    if args.raw:
+        records = []
+        totalPages = 0
+        for element in functions.soap_iterparse(settings, "billing", soap_action, "GetTerminalUsageDataDetails", {
+                "messageId": messageId,
+                "version": version,
+                "licenseKey": settings["licensekey"],
+                "iccid": iccid,
+                "cycleStartDate": args.startdate,
+                "pageNumber": page
+            }, [USAGEDETAIL, TOTALPAGES]):
+            if element.tag == USAGEDETAIL:
+                records.append({
+                    "dataVolume": decimal.Decimal(element.findtext(DATAVOLUME)),
+                    "duration": int(element.findtext(DURATION)),
+                    "sessionStartTime": zeep.xsd.DateTime().pythonvalue(element.findtext(SESSIONSTARTTIME))
+                })
+            else:
+                totalPages = int(element.text)
+        return records, totalPages
+
+    result = client.service.GetTerminalUsageDataDetails(
+        messageId=messageId,
+        version=version,
+        licenseKey=settings["licensekey"],
+        iccid=iccid,
+        cycleStartDate=args.startdate,
+        pageNumber=page)
+
+    # A page without records has no usageDetails element at all
+    #
+    if result.usageDetails is None:
+        return [], result.totalPages
+    return result.usageDetails["usageDetail"], result.totalPages
+
+# Streaming aggregator for the records of a device, summarizing records
+# with the same session start time. At most 'window' sessions are kept open;
+# when another session starts, the session that started first is complete
+# and written out. A record for a session that was already written is not
+# lost: it starts another summary for that session, which is flagged as
+# partial and has to be added to the earlier one
+#
+class SessionAggregator:
+
+    def __init__(self, writer, window):
+        self.writer = writer
+        self.window = window
+        self.sessions = {}
+        self.starts = []
+        self.written = None
+        self.late = 0
+        self.records = 0
+        self.volume = 0
+        self.duration = 0
+
+    def add(self, record):
+        epoch = record["starttime_epoch"]
+        session = self.sessions.get(epoch)
+        if session is None:
+            late = self.written is not None and epoch <= self.written
+            session = self.sessions[epoch] = {
+                "iccid": record["iccid"],
+                "starttime_iso": record["starttime_iso"],
+                "starttime_epoch": epoch,
+                "records": 0,
+                "volume": 0,
+                "duration": 0,
+                "partial": late
+            }
+            if late:
+                self.late += 1
+            heapq.heappush(self.starts, epoch)
+
+        session["records"] += 1
+        session["volume"] += record["volume"]
+        session["duration"] += record["duration"]
+
+        if len(self.starts) > self.window:
+            self.write_first()
+
+    def write_first(self):
+        epoch = heapq.heappop(self.starts)
+        self.written = epoch if self.written is None else max(self.written, epoch)
+        session = self.sessions.pop(epoch)
+        self.records += session["records"]
+        self.volume += session["volume"]
+        self.duration += session["duration"]
+        self.writer.write(session)
+        self.writer.flush()
+
+    def close(self):
+        while self.starts:
+            self.write_first()
+        if self.late:
+            print(f"Wrote {self.late} partial session(s) for records that arrived after their session was written; increase --window to avoid them", file=sys.stderr)
+
+# Function to open the records of a device in the store, which is used for
+# closed cycles. Returns a file with the records as JSON lines, or None if
+# the records have to be requested
+#
+def stored_records(iccid):
+    if not closed or args.cache != "use":
+        return None
+    stored = functions.store_open(url, "usage", [args.site, iccid, args.startdate])
+    if stored is not None:
+        print(f"Records for the device ICCID {iccid} served from store", file=sys.stderr)
+    return stored
 
-# Set SOAP action in the header
+# Generator for the records of a device, which yields the records of each
+# page as soon as the page is received. For closed cycles the records are
+# also written to the store, and only added to it if all pages were received
 #
-client.transport.session.headers['SOAPAction'] = soap_action
+def device_records(iccid):
+    print("Getting all records for the device ICCID", iccid, file=sys.stderr)
 
-allrecs = []
+    if closed and args.cache != "off":
+        store = functions.StoreWriter(url)
+    else:
+        store = None
+
+    try:
+        page = 1
+        totalPages = 1
+
+        while page <= totalPages:
+
+            # Call the SOAP method
+            #
+            records, totalPages = functions.soap_call(settings, SoapErrorRetryable, get_page, iccid, page)
+
+            # Process each record that is returned
+            #
+            for record in records:
+                recout = {}
+                recout["iccid"] = iccid
+                recout["volume"] = int(record["dataVolume"].to_integral())
+                recout["duration"] = record["duration"]
+                recout["starttime_iso"] = record["sessionStartTime"].isoformat()
+                recout["starttime_epoch"] = int(record["sessionStartTime"].timestamp())
+                if store is not None:
+                    store.write(json.dumps(recout) + "\n")
+                yield recout
+
+            page += 1
+            if page <= totalPages:
+                print(f"Requesting page {page} of {totalPages} for ICCID {iccid}", file=sys.stderr)
+
+    except BaseException:
+        if store is not None:
+            store.close()
+        raise
+
+    if store is not None:
+        store.commit("usage", [args.site, iccid, args.startdate]).close()
+
+# Function to get all records of a device in a worker of fan_out, written as
+# JSON lines to a temporary file while the pages are received. Returns the
+# file opened for reading; if a page fails, the file is thrown away
+#
+def crawl(iccid):
+    stored = stored_records(iccid)
+    if stored is not None:
+        return stored
+
+    spool = tempfile.TemporaryFile("w+", encoding="utf-8")
+    try:
+        for record in device_records(iccid):
+            spool.write(json.dumps(record) + "\n")
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+writer = functions.RecordWriter(jsonl=args.jsonl)
+failed = []
 reccount = 0
 totalduration = 0
 totalvolume = 0
 
-page = 1
-totalPages = 100
+# Function to summarize duration and volume of the records of a device, either
+# for each session (which is identified by records having the same
+# sessionStartTime), which is written as soon as it is complete, or for all
+# records, which are kept in memory to sort them by start time. Only the
+# records that were written are counted
+#
+def summarize(records):
+    global reccount, totalduration, totalvolume
+    if args.sessions:
+        aggregator = SessionAggregator(writer, args.window)
+        try:
+            for record in records:
+                aggregator.add(record)
+            aggregator.close()
+        finally:
+            reccount += aggregator.records
+            totalduration += aggregator.duration
+            totalvolume += aggregator.volume
+    else:
+        allrecs = sorted(records, key=lambda d: d['starttime_epoch'])
+        writer.write_all(allrecs)
+        reccount += len(allrecs)
+        totalduration += sum(record["duration"] for record in allrecs)
+        totalvolume += sum(record["volume"] for record in allrecs)
 
-print("Getting all records for the device ICCID", args.iccid, file=sys.stderr)
+# Function to report a device that failed
+#
+def report(iccid, error):
+    print("Error", error.message, ":", SoapError(error.message), f"for ICCID {iccid}", file=sys.stderr)
+    failed.append([iccid, error.message, SoapError(error.message)])
 
-while page <= totalPages:
+if args.concurrency == 1 or len(iccids) == 1:
 
-    # Call the SOAP method
+    # Request the devices one by one and process the records of each page as
+    # soon as it is received. When summarizing sessions, the sessions of a
+    # device that fails that were complete before the failed page are
+    # already written
     #
-    try:
-        result = client.service.GetTerminalUsageDataDetails(
-            messageId=messageId,
-            version=version,
-            licenseKey=settings["licensekey"],
-            iccid=args.iccid,
-            cycleStartDate=args.startdate,
-            pageNumber=page)
-
-        # Process each record that is returned and
-        # extract summarize duration and volume for each session
-        # (which is identified by records having the same sessionStartTime)
-        #
-        for record in result.usageDetails["usageDetail"]:
-            volume = int(record["dataVolume"].to_integral())
-            duration = record["duration"]
-            starttime = record["sessionStartTime"].isoformat()
-            epoch = int(record["sessionStartTime"].timestamp())
-
-            totalduration += duration
-            totalvolume += volume
-            reccount += 1
-
-            recout = {}
-            recout["volume"] = volume
-            recout["duration"] = duration
-            recout["starttime_iso"] = starttime
-            recout["starttime_epoch"] = epoch
-            allrecs.append(recout)
-
-        totalPages = result.totalPages
-        page += 1
-        if page <= totalPages:
-            print(f"Requesting page {page} of {totalPages}", file=sys.stderr)
-
-    except zeep.exceptions.Fault as fault:
-        print("Error", fault.message, ":", SoapError(fault.message))
-        break
-
-if allrecs != []:
-
-    sorted_allrecs = sorted(allrecs, key=lambda d: d['starttime_epoch'])
-    print(json.dumps(sorted_allrecs, indent=4))
+    for iccid in dict.fromkeys(iccids):
+        stored = stored_records(iccid)
+        try:
+            if stored is None:
+                summarize(device_records(iccid))
+            else:
+                with stored:
+                    summarize(json.loads(line) for line in stored)
+        except zeep.exceptions.Fault as error:
+            report(iccid, error)
+            if args.sessions:
+                print(f"The sessions already written for ICCID {iccid} don't include all of its records", file=sys.stderr)
+
+else:
+
+    # Request the devices in parallel and process their records in the order
+    # of the ICCIDs. Only devices whose records were all received are
+    # written, so a device that fails is only reported
+    #
+    for iccid, records, error in functions.fan_out(iccids, crawl, args.concurrency, progress=10):
+        if isinstance(error, zeep.exceptions.Fault):
+            report(iccid, error)
+            continue
+        elif error != None:
+            raise error
+
+        with records:
+            summarize(json.loads(line) for line in records)
+
+if reccount > 0:
+    writer.close()
 
     # Print a summary of the records
     #
     print(f"Counted {str(reccount)} record(s) with a total duration of {datetime.timedelta(seconds = totalduration)} hours and a volume of {str(totalvolume)} KB", file=sys.stderr)
+
+if args.errors != None:
+    with open(args.errors, "w", newline="") as errorfile:
+        csv.writer(errorfile).writerows(failed)
@@ -45,12 +45,118 @@ import logging
 import http.client as http_client
 import json
 import re
+import csv
+import atexit
+import collections
+import datetime
+import threading
+import tempfile
+import hashlib
+import random
+import email.utils
+import functools
+import asyncio
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+import urllib.parse
+import xml.sax.saxutils
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from requests.exceptions import RequestException
 
 try:
     import zeep
+    import zeep.cache
+    import zeep.exceptions
+    from zeep.transports import Transport
+    from zeep.wsse.username import UsernameToken
+    from lxml import etree
 except ImportError:
     pass
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Errors raised by get_data, so that bulk jobs can handle a failed request
+# and continue with the next one
+#
+class ControlCenterError(Exception):
+    def __init__(self, message, url=None, status=None):
+        super().__init__(message)
+        self.url = url
+        self.status = status
+
+class BadRequestError(ControlCenterError):
+    pass
+
+class AuthenticationError(ControlCenterError):
+    pass
+
+class NotFoundError(ControlCenterError):
+    pass
+
+class ServerError(ControlCenterError):
+    pass
+
+class UnexpectedStatusError(ControlCenterError):
+    pass
+
+class RequestFailedError(ControlCenterError):
+    pass
+
+class RetriesExhaustedError(ControlCenterError):
+    pass
+
+# Scripts that don't handle these errors themselves exit with the error
+# message instead of a traceback
+#
+def excepthook(type, value, traceback):
+    if issubclass(type, ControlCenterError):
+        print(value, file=sys.stderr)
+    else:
+        sys.__excepthook__(type, value, traceback)
+
+sys.excepthook = excepthook
+
+# Settings of all sites loaded so far; used to look up site specific
+# options (e.g. the connection pool size) for a given URL
+#
+site_settings = {}
+
+# Pooled HTTP sessions, one per scheme, host and credentials
+#
+sessions = {}
+sessions_lock = threading.Lock()
+
+# Request statistics per endpoint, collected by get_data and written at exit
+# when enabled with enable_stats(); latencies are counted in histogram buckets
+# with the given upper bounds in seconds
+#
+stats = {}
+stats_lock = threading.Lock()
+stats_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Serializes access to the rate limiter state between threads
+#
+ratelimit_lock = threading.Lock()
+
+# Namespaces of the SOAP API, used by the raw SOAP calls that bypass zeep
+#
+SOAP_ENVELOPE_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+SOAP_SCHEMA_NS = "http://api.jasperwireless.com/ws/schema"
+WSSE_NS = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd"
+WSSE_PASSWORD_TEXT = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-username-token-profile-1.0#PasswordText"
+
+# Pooled sessions for the raw SOAP calls, one per site
+#
+soap_sessions = {}
+
+# URL of the last SOAP request of each thread, to count retries of SOAP
+# calls for the endpoint of the service
+#
+soap_last_request = threading.local()
     
 def load_site_settings(site):
 
@@ -69,9 +175,450 @@ def load_site_settings(site):
     if "password" not in settings[site] and "username" in settings[site]:
         settings[site]["password"]=getpass.getpass("Please enter password for user " + settings[site]["username"] + " on site " + site + ": ")
 
+    site_settings[site] = settings[site]
+
     return settings[site]
 
-def get_data (url, username, password, params={}, method="get", jsondata={}, debug=False ):
+# Return an option from the settings of the site whose REST, SOAP or WSDL
+# URL matches the given URL, or the default if no such site or option exists
+#
+def get_site_option(url, option, default=None):
+    for settings in site_settings.values():
+        if option not in settings:
+            continue
+        for key in ["resturl", "soapurl", "wsdlurl"]:
+            if key in settings and url.startswith(str(settings[key])):
+                return settings[option]
+    return default
+
+# Return a keep-alive session for the host of the given URL, with a
+# connection pool sized by the "poolsize" site option and the credentials
+# bound once, so that consecutive requests reuse the same TCP/TLS connections
+#
+def get_session(url, username='', password=''):
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc, username, password)
+
+    with sessions_lock:
+        if key not in sessions:
+            poolsize = int(get_site_option(url, "poolsize", 10))
+            session = requests.Session()
+            session.mount(parts.scheme + "://", HTTPAdapter(pool_connections=1, pool_maxsize=poolsize))
+            if username != '':
+                session.auth = (username, password)
+            sessions[key] = session
+        return sessions[key]
+
+# Proactive token bucket rate limiter: wait until the "ratelimit" site option
+# (calls per second, with bursts of up to "ratelimitburst" calls) allows
+# another request to the host of the URL. The bucket is kept in a small state
+# file in the temp directory that is locked while it is updated, so that it
+# is shared by all threads and all scripts running on the same host
+#
+def throttle(url):
+    rate = get_site_option(url, "ratelimit")
+    if rate is None:
+        return
+    rate = float(rate)
+    burst = float(get_site_option(url, "ratelimitburst", 1))
+
+    host = urllib.parse.urlsplit(url).netloc
+    statefile = os.path.join(tempfile.gettempdir(), "cc-ratelimit-" + hashlib.sha1(host.encode()).hexdigest()[:16])
+
+    with ratelimit_lock:
+        with open(statefile, "a+") as state:
+            if fcntl is not None:
+                fcntl.flock(state, fcntl.LOCK_EX)
+            state.seek(0)
+            now = time.time()
+            try:
+                tokens, stamp = [float(value) for value in state.read().split()]
+            except ValueError:
+                tokens, stamp = burst, now
+
+            # Refill the bucket and reserve a token; a negative balance is
+            # the time the caller has to wait for its turn
+            #
+            tokens = min(burst, tokens + (now - stamp) * rate) - 1
+            state.seek(0)
+            state.truncate()
+            state.write(f"{tokens} {now}")
+
+    if tokens < 0:
+        time.sleep(-tokens / rate)
+
+# Retry policy used by get_data: exponential backoff with full jitter that
+# honours the Retry-After header of the server, limited by a number of tries
+# and a total time budget in seconds. The defaults can be changed per site
+# with the "retry" option in settings.yaml, including per status overrides
+# of base and cap (see settings-sample.yaml). Subclass and override delay()
+# to plug in a different schedule
+#
+class RetryPolicy:
+
+    def __init__(self, tries=5, base=2, cap=60, budget=300, statuses=None):
+        self.tries = max(1, int(tries))
+        self.base = float(base)
+        self.cap = float(cap)
+        self.budget = float(budget)
+        if statuses is None:
+            statuses = {429: {}, 503: {}, 504: {}}
+        self.statuses = {int(status): options or {} for status, options in statuses.items()}
+
+    # Status codes to retry; None stands for connection errors
+    #
+    def retryable(self, status):
+        return status is None or status in self.statuses
+
+    # Delay before the next try after the given attempt (counting from 0)
+    #
+    def delay(self, attempt, status=None, retry_after=None):
+        options = self.statuses.get(status, {})
+        base = float(options.get("base", self.base))
+        cap = float(options.get("cap", self.cap))
+        delay = random.uniform(0, min(cap, base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    # Return the delay before the next try, or None if the number of tries
+    # or the time budget (measured from 'started') would be exceeded
+    #
+    def next_delay(self, attempt, started, status=None, retry_after=None):
+        if attempt + 1 >= self.tries:
+            return None
+        delay = self.delay(attempt, status, parse_retry_after(retry_after))
+        if time.monotonic() - started + delay > self.budget:
+            return None
+        return delay
+
+# Convert a Retry-After header (seconds or HTTP date) into seconds
+#
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Return the retry policy configured for the site of the URL
+#
+def get_retry_policy(url):
+    return RetryPolicy(**get_site_option(url, "retry", {}))
+
+# Return the number of seconds responses for the URL may be served from the
+# on-disk cache, or None if the URL is not cached. The TTLs are configured per
+# endpoint with the "cache" site option as regular expressions matched
+# against the URL path; the first matching expression wins
+#
+def get_cache_ttl(url):
+    cache = get_site_option(url, "cache")
+    if not cache:
+        return None
+    path = urllib.parse.urlsplit(url).path
+    for pattern, ttl in cache.get("ttl", {}).items():
+        if re.search(pattern, path):
+            return float(ttl)
+    return None
+
+# Return a subdirectory of the cache directory of the site for the URL,
+# created if needed
+#
+def get_cache_dir(url, subdir="responses"):
+    cache = get_site_option(url, "cache", {})
+    cachedir = os.path.join(os.path.expanduser(cache.get("dir", "~/.cache/cisco-iot-control-center")), subdir)
+    os.makedirs(cachedir, exist_ok=True)
+    return cachedir
+
+# Build the cache key from method, URL, parameters and user
+#
+def get_cache_key(method, url, params, username):
+    key = json.dumps([method, url, sorted((str(k), str(v)) for k, v in params.items()), username])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+# Read a cache entry; returns the metadata and the content, or None
+#
+def cache_load(url, key):
+    filename = os.path.join(get_cache_dir(url), key)
+    try:
+        with open(filename + ".json") as metafile:
+            meta = json.load(metafile)
+        with open(filename + ".body", "rb") as bodyfile:
+            content = bodyfile.read()
+    except (OSError, ValueError):
+        return None
+    return meta, content
+
+# Write a cache entry and evict the least recently used entries if the
+# cache exceeds the "maxsize" (MB) of the "cache" site option
+#
+def cache_store(url, key, response, content):
+    cachedir = get_cache_dir(url)
+    filename = os.path.join(cachedir, key)
+    meta = {
+        "url": url,
+        "stored": time.time(),
+        "etag": response.headers.get("ETag"),
+        "lastmodified": response.headers.get("Last-Modified")
+    }
+    for suffix, data in [(".body", content), (".json", json.dumps(meta).encode())]:
+        tmpname = f"{filename}{suffix}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmpname, "wb") as tmpfile:
+            tmpfile.write(data)
+        os.replace(tmpname, filename + suffix)
+
+    maxsize = float(get_site_option(url, "cache", {}).get("maxsize", 100)) * 1024 * 1024
+    entries = []
+    for name in os.listdir(cachedir):
+        if name.endswith(".body"):
+            try:
+                stat = os.stat(os.path.join(cachedir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name[:-5]))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= maxsize:
+            break
+        for suffix in [".body", ".json"]:
+            try:
+                os.remove(os.path.join(cachedir, name + suffix))
+            except OSError:
+                pass
+        total -= size
+
+# Mark a cache entry as used (for LRU eviction) and optionally as revalidated
+#
+def cache_touch(url, key, revalidated=False):
+    filename = os.path.join(get_cache_dir(url), key)
+    try:
+        os.utime(filename + ".body")
+        if revalidated:
+            with open(filename + ".json") as metafile:
+                meta = json.load(metafile)
+            meta["stored"] = time.time()
+            with open(filename + ".json", "w") as metafile:
+                json.dump(meta, metafile)
+    except (OSError, ValueError):
+        pass
+
+# Content-addressed store for results that never change once they exist,
+# e.g. the usage of a closed billing cycle. Each result is written once as
+# an object named by the hash of its content, so identical results are
+# stored only once, and a reference named by the hash of the key (a list of
+# strings such as site, ICCID and cycle) points to it. Unlike the response
+# cache, the store has no TTL and no eviction
+#
+def get_store_ref(url, namespace, key):
+    name = hashlib.sha256(json.dumps([str(part) for part in key]).encode()).hexdigest()
+    return os.path.join(get_cache_dir(url, os.path.join("store", "refs", namespace)), name)
+
+def get_store_object(url, digest):
+    return os.path.join(get_cache_dir(url, os.path.join("store", "objects", digest[:2])), digest)
+
+def store_write(filename, data):
+    tmpname = f"{filename}.{os.getpid()}.{threading.get_ident()}"
+    with open(tmpname, "wb") as tmpfile:
+        tmpfile.write(data)
+    os.replace(tmpname, filename)
+
+# Writer for a result that is too large to keep in memory, e.g. JSON lines
+# written while the pages of the result are received. The content goes to a
+# temporary file in the store and is hashed on the way; commit() adds it as
+# an object under the key once it is complete, close() before that throws
+# it away
+#
+class StoreWriter:
+
+    def __init__(self, url):
+        self.url = url
+        self.hash = hashlib.sha256()
+        self.file = tempfile.NamedTemporaryFile(dir=get_cache_dir(url, os.path.join("store", "tmp")), delete=False)
+
+    def write(self, data):
+        data = data.encode("utf-8")
+        self.hash.update(data)
+        self.file.write(data)
+
+    # Add the content under the key and return the stored object opened
+    # for reading
+    #
+    def commit(self, namespace, key):
+        self.file.close()
+        digest = self.hash.hexdigest()
+        filename = get_store_object(self.url, digest)
+        if os.path.exists(filename):
+            os.remove(self.file.name)
+        else:
+            os.replace(self.file.name, filename)
+        store_write(get_store_ref(self.url, namespace, key), digest.encode())
+        return open(filename, encoding="utf-8")
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            os.remove(self.file.name)
+
+# Open the stored result for the key for reading, or return None if there
+# is none or its content doesn't match its hash
+#
+def store_open(url, namespace, key):
+    try:
+        with open(get_store_ref(url, namespace, key)) as reffile:
+            digest = reffile.read().strip()
+        filename = get_store_object(url, digest)
+        hash = hashlib.sha256()
+        with open(filename, "rb") as objectfile:
+            for chunk in iter(lambda: objectfile.read(1024 * 1024), b""):
+                hash.update(chunk)
+        if hash.hexdigest() != digest:
+            return None
+        return open(filename, encoding="utf-8")
+    except OSError:
+        return None
+
+# Return the stored result for the key, or None if there is none
+#
+def store_load(url, namespace, key):
+    objectfile = store_open(url, namespace, key)
+    if objectfile is None:
+        return None
+    with objectfile:
+        return json.load(objectfile)
+
+# Store a result for the key; returns the hash of its content
+#
+def store_save(url, namespace, key, data):
+    content = json.dumps(data).encode()
+    digest = hashlib.sha256(content).hexdigest()
+    filename = get_store_object(url, digest)
+    if not os.path.exists(filename):
+        store_write(filename, content)
+    store_write(get_store_ref(url, namespace, key), digest.encode())
+    return digest
+
+# Endpoint name used for statistics: the URL path with IDs (e.g. ICCIDs or
+# account IDs) replaced by a placeholder
+#
+def get_endpoint(url):
+    return re.sub(r"/\d[^/]*", "/{id}", urllib.parse.urlsplit(url).path)
+
+# Return the statistics entry of an endpoint; call with stats_lock held
+#
+def get_stats_entry(url):
+    return stats.setdefault(get_endpoint(url), {
+        "requests": 0,
+        "retries": 0,
+        "bytes": 0,
+        "seconds": 0.0,
+        "statuses": {},
+        "buckets": [0] * (len(stats_buckets) + 1)
+    })
+
+# Record one request in the statistics; status is the HTTP status code,
+# "error" for connection errors or "cached" for responses from the cache
+#
+def record_request(url, status, seconds=0.0, size=0):
+    with stats_lock:
+        entry = get_stats_entry(url)
+        entry["requests"] += 1
+        entry["bytes"] += size
+        entry["seconds"] += seconds
+        entry["statuses"][str(status)] = entry["statuses"].get(str(status), 0) + 1
+        if status != "cached":
+            for index, bound in enumerate(stats_buckets + [float("inf")]):
+                if seconds <= bound:
+                    entry["buckets"][index] += 1
+                    break
+
+# Record that a request of an endpoint is retried
+#
+def record_retry(url):
+    with stats_lock:
+        get_stats_entry(url)["retries"] += 1
+
+# Estimate a latency percentile (0..1) from the histogram buckets of an entry
+#
+def get_percentile(entry, percentile):
+    total = sum(entry["buckets"])
+    if total == 0:
+        return 0.0
+    count = 0
+    for index, bucket in enumerate(entry["buckets"]):
+        count += bucket
+        if count >= percentile * total:
+            return stats_buckets[index] if index < len(stats_buckets) else float("inf")
+    return float("inf")
+
+# Write the request statistics: "-" prints a summary to stderr, a file name
+# ending with ".prom" is written in the Prometheus textfile format and any
+# other file name as JSON
+#
+def write_stats(target):
+    with stats_lock:
+        snapshot = json.loads(json.dumps(stats))
+
+    if target == "-":
+        print(f"{'Endpoint':<50} {'Requests':>8} {'Retries':>7} {'Avg(s)':>7} {'P50(s)':>7} {'P95(s)':>7} {'Bytes':>12}  Statuses", file=sys.stderr)
+        for endpoint, entry in sorted(snapshot.items()):
+            timed = sum(entry["buckets"])
+            average = entry["seconds"] / timed if timed else 0.0
+            statuses = " ".join(f"{status}:{count}" for status, count in sorted(entry["statuses"].items()))
+            print(f"{endpoint:<50} {entry['requests']:>8} {entry['retries']:>7} {average:>7.3f} {get_percentile(entry, 0.5):>7} {get_percentile(entry, 0.95):>7} {entry['bytes']:>12}  {statuses}", file=sys.stderr)
+
+    elif target.endswith(".prom"):
+        lines = []
+        lines.append("# TYPE cc_requests_total counter")
+        for endpoint, entry in sorted(snapshot.items()):
+            for status, count in sorted(entry["statuses"].items()):
+                lines.append(f'cc_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+        lines.append("# TYPE cc_request_retries_total counter")
+        for endpoint, entry in sorted(snapshot.items()):
+            lines.append(f'cc_request_retries_total{{endpoint="{endpoint}"}} {entry["retries"]}')
+        lines.append("# TYPE cc_response_bytes_total counter")
+        for endpoint, entry in sorted(snapshot.items()):
+            lines.append(f'cc_response_bytes_total{{endpoint="{endpoint}"}} {entry["bytes"]}')
+        lines.append("# TYPE cc_request_duration_seconds histogram")
+        for endpoint, entry in sorted(snapshot.items()):
+            count = 0
+            for bound, bucket in zip(stats_buckets + ["+Inf"], entry["buckets"]):
+                count += bucket
+                lines.append(f'cc_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+            lines.append(f'cc_request_duration_seconds_sum{{endpoint="{endpoint}"}} {entry["seconds"]}')
+            lines.append(f'cc_request_duration_seconds_count{{endpoint="{endpoint}"}} {count}')
+
+        # Write to a temporary file first, as the textfile collector may
+        # read the file at any time
+        #
+        with open(target + ".tmp", "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(target + ".tmp", target)
+
+    else:
+        with open(target, "w") as file:
+            json.dump({"buckets": stats_buckets, "endpoints": snapshot}, file, indent=4)
+
+# Write the request statistics to the target (see write_stats) at exit;
+# does nothing if target is None
+#
+def enable_stats(target):
+    if target is not None:
+        atexit.register(write_stats, target)
+
+# Perform a REST request and return the content of the response.
+# GET requests for endpoints with a TTL in the "cache" site option are served
+# from the on-disk cache: cache="use" returns fresh entries and revalidates
+# stale ones with ETag/Last-Modified, cache="refresh" always downloads and
+# updates the entry, and cache="off" bypasses the cache. The body of an
+# HTTP 400 response is returned like a result, unless bad_request="raise",
+# which bulk jobs use to record the request as failed
+#
+def get_data (url, username, password, params={}, method="get", jsondata={}, debug=False, retry=None, cache="use", bad_request="return" ):
     
     if debug:
         http_client.HTTPConnection.debuglevel = 1
@@ -81,73 +628,94 @@ def get_data (url, username, password, params={}, method="get", jsondata={}, deb
         requests_log.setLevel(logging.DEBUG)
         requests_log.propagate = True
 
-    # Retry requests up to 5 times if needed
+    if method not in ["get", "post", "put"]:
+        raise ValueError(f"Unknown method '{method}'")
+
+    session = get_session(url, username, password)
+
+    # Look up the response cache
+    #
+    ttl = None
+    entry = None
+    headers = {}
+    if method == "get" and cache != "off":
+        ttl = get_cache_ttl(url)
+    if ttl is not None:
+        key = get_cache_key(method, url, params, username)
+        if cache == "use":
+            entry = cache_load(url, key)
+        if entry is not None:
+            meta, content = entry
+            if time.time() - meta["stored"] < ttl:
+                cache_touch(url, key)
+                record_request(url, "cached")
+                print (f"Request served from cache", file=sys.stderr)
+                return content
+            if meta["etag"]:
+                headers["If-None-Match"] = meta["etag"]
+            if meta["lastmodified"]:
+                headers["If-Modified-Since"] = meta["lastmodified"]
+
+    # Retry requests according to the retry policy
     #
-    delay = 0
-    delayinc = 10
+    policy = retry if retry is not None else get_retry_policy(url)
+    started = time.monotonic()
 
-    for _ in range(5):
+    for attempt in range(policy.tries):
         try:
 
+            throttle(url)
+            requeststart = time.monotonic()
+
             if method == "get":
-                if username !='':
-                    myResponse = requests.get(
-                        url,
-                        auth=(username,password),
-                        params=params
+                myResponse = session.get(
+                    url,
+                    params=params,
+                    headers=headers
                 )
-                else:
-                    myResponse = requests.get(
-                        url,
-                        params=params
-                    )
             elif method == "post":
-                if username !='':
-                    myResponse = requests.post(
-                        url,
-                        auth=(username,password),
-                        json=jsondata,
-                        params=params
-                )
-                else:
-                    myResponse = requests.post(
-                        url,
-                        json=jsondata,
-                        params=params
-                    )
-            elif method == "put":
-                if username !='':
-                    myResponse = requests.put(
-                        url,
-                        auth=(username,password),
-                        json=jsondata,
-                        params=params
+                myResponse = session.post(
+                    url,
+                    json=jsondata,
+                    params=params
                 )
-                else:
-                    myResponse = requests.put(
-                        url,
-                        json=jsondata,
-                        params=params
-                    )
             else:
-                sys.exit(f"Unknown method '{method}'")
-     
+                myResponse = session.put(
+                    url,
+                    json=jsondata,
+                    params=params
+                )
 
-            if myResponse.ok:
+            record_request(url, myResponse.status_code, time.monotonic() - requeststart, len(myResponse.content))
+
+            if myResponse.status_code == 304 and entry is not None:
+                cache_touch(url, key, revalidated=True)
+                print (f"Request successful, cached response not modified", file=sys.stderr)
+                return entry[1]
+            elif myResponse.ok:
                 print (f"Request successful", file=sys.stderr)
+                if ttl is not None:
+                    cache_store(url, key, myResponse, myResponse.content)
                 return myResponse.content
-            elif myResponse.status_code in [429,503,504]:
-                delay+=delayinc
-                print (f"Received HTTP error {myResponse.status_code}; retrying in {delay} seconds", file=sys.stderr)
+            elif policy.retryable(myResponse.status_code):
+                delay = policy.next_delay(attempt, started, myResponse.status_code, myResponse.headers.get("Retry-After"))
+                if delay is None:
+                    error = f"Received HTTP error {myResponse.status_code}"
+                    status = myResponse.status_code
+                    break
+                print (f"Received HTTP error {myResponse.status_code}; retrying in {delay:.1f} seconds", file=sys.stderr)
+                record_retry(url)
                 time.sleep(delay)
                 continue
             elif myResponse.status_code == 400:
+                if bad_request == "raise":
+                    raise BadRequestError(f"Received HTTP error 400: Bad request: {myResponse.text}", url, 400)
                 print("Received HTTP error 400: Bad request", file=sys.stderr)
                 return myResponse.content
             elif myResponse.status_code == 401:
-                sys.exit (f"Received HTTP error 401: Check username and password")
+                raise AuthenticationError(f"Received HTTP error 401: Check username and password", url, 401)
             elif myResponse.status_code == 404:
-                sys.exit (f"Received HTTP error 404: Check URL '{url}'")
+                raise NotFoundError(f"Received HTTP error 404: Check URL '{url}'", url, 404)
             elif myResponse.status_code == 500:
                 print(f"Received HTTP error 500:", file=sys.stderr)
                 print (myResponse.text, file=sys.stderr)
@@ -161,34 +729,467 @@ def get_data (url, username, password, params={}, method="get", jsondata={}, deb
                             print (f"      filter: {property['property']} {property['type']} {property['value']}", file=sys.stderr)
                     else:
                         print (f"  {key}: {value}")
-                sys.exit(f"Check parameters for URL '{url}'")
+                raise ServerError(f"Received HTTP error 500: Check parameters for URL '{url}'", url, 500)
             else:
-                sys.exit (f"Received unexpected HTTP error {myResponse.status_code}")
+                raise UnexpectedStatusError(f"Received unexpected HTTP error {myResponse.status_code}", url, myResponse.status_code)
 
         except requests.exceptions.HTTPError as errh:
-            sys.exit (f"Http Error: {errh}")
+            raise RequestFailedError(f"Http Error: {errh}", url) from errh
         except requests.exceptions.ConnectionError as errc:
-            delay+=delayinc
-            print (f"Error Connecting: {errc}, retrying in {delay} seconds", file=sys.stderr)
+            record_request(url, "error", time.monotonic() - requeststart)
+            delay = policy.next_delay(attempt, started)
+            if delay is None:
+                error = f"Error Connecting: {errc}"
+                status = None
+                break
+            print (f"Error Connecting: {errc}, retrying in {delay:.1f} seconds", file=sys.stderr)
+            record_retry(url)
             time.sleep(delay)
         except requests.exceptions.Timeout as errt:
-            sys.exit (f"Timeout Error: {errt}")
+            raise RequestFailedError(f"Timeout Error: {errt}", url) from errt
         except requests.exceptions.RequestException as err:
-            sys.exit (f"Oops, some unexpected error: {err}")
+            raise RequestFailedError(f"Oops, some unexpected error: {err}", url) from err
+
+    raise RetriesExhaustedError(f"{error}; giving up after {attempt + 1} tries", url, status)
+
+# Asynchronous counterpart of get_data; the request is run on the pooled
+# session in a worker thread, so retries and status handling are the same.
+# An optional asyncio.Semaphore limits the number of requests in flight
+#
+async def get_data_async(url, username, password, params={}, method="get", jsondata={}, debug=False, semaphore=None, executor=None, cache="use", bad_request="return"):
+    loop = asyncio.get_running_loop()
+    request = functools.partial(get_data, url, username, password, params, method, jsondata, debug, cache=cache, bad_request=bad_request)
+    if semaphore is None:
+        return await loop.run_in_executor(executor, request)
+    async with semaphore:
+        return await loop.run_in_executor(executor, request)
+
+# Request a list of URLs with get_data_async and at most 'concurrency'
+# requests in flight. Returns (url, content, error) for each URL in the
+# order of the URLs, like fan_out; errors that are not about a single URL
+# (see is_run_error) are raised
+#
+def get_data_many(urls, username, password, params={}, concurrency=10, debug=False, cache="use", bad_request="return"):
+
+    async def request(url, semaphore, executor):
+        try:
+            return url, await get_data_async(url, username, password, params, debug=debug, semaphore=semaphore, executor=executor, cache=cache, bad_request=bad_request), None
+        except Exception as error:
+            if is_run_error(error):
+                raise
+            return url, None, error
+
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return await asyncio.gather(*[request(url, semaphore, executor) for url in urls])
+
+    return asyncio.run(run())
+
+# Generator over the pages of a paginated REST endpoint, yielding the page
+# number and the decoded JSON of each page in order until is_last_page()
+# returns True. With prefetch > 0 up to that many following pages are
+# requested concurrently while the current page is processed; pages that
+# were requested beyond the last page are discarded
+#
+def get_pages(url, username, password, params={}, prefetch=0, page_param="pageNumber", is_last_page=lambda jData, page: jData["lastPage"], start_page=1, debug=False, cache="use"):
+    executor = ThreadPoolExecutor(max_workers=prefetch + 1)
+    pending = collections.deque()
+    next_page = start_page
+
+    try:
+        while True:
+            while len(pending) < prefetch + 1:
+                print(f"Requesting page {next_page}", file=sys.stderr)
+                pageparams = dict(params)
+                pageparams[page_param] = next_page
+                pending.append((next_page, executor.submit(get_data, url, username, password, pageparams, debug=debug, cache=cache)))
+                next_page += 1
+
+            page, future = pending.popleft()
+            jData = json.loads(future.result())
+            lastpage = is_last_page(jData, page)
+
+            yield page, jData
+
+            if lastpage:
+                break
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+# Write records as they arrive, either as JSON lines or as a JSON array
+# formatted like json.dumps(records, indent=4), so that large result sets
+# don't need to be kept in memory. 'count' is the number of records that
+# were already written to the file before
+#
+class RecordWriter:
+
+    def __init__(self, file=sys.stdout, jsonl=False, count=0):
+        self.file = file
+        self.jsonl = jsonl
+        self.count = count
+
+    def write(self, record):
+        if self.jsonl:
+            self.file.write(json.dumps(record) + "\n")
+        else:
+            self.file.write("[\n    " if self.count == 0 else ",\n    ")
+            self.file.write(json.dumps(record, indent=4).replace("\n", "\n    "))
+        self.count += 1
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+        self.flush()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.jsonl:
+            self.file.write("[]\n" if self.count == 0 else "\n]\n")
+        self.flush()
+
+# Open the output file of a paginated crawl that can be resumed with a
+# checkpoint (see save_checkpoint). Returns a RecordWriter for the file and
+# the first page to request. With resume=True and a checkpoint for the same
+# query, the output is truncated to the checkpointed size and the crawl
+# continues after the last completed page
+#
+def open_checkpointed_output(output, query, jsonl=False, resume=False):
+    checkpointfile = output + ".checkpoint"
+    query = json.loads(json.dumps(query))
+
+    if resume and os.path.exists(checkpointfile):
+        with open(checkpointfile) as file:
+            checkpoint = json.load(file)
+        if checkpoint["query"] != query or checkpoint["jsonl"] != jsonl:
+            sys.exit(f"Checkpoint {checkpointfile} was written for different parameters")
+
+        print(f"Resuming after page {checkpoint['page']} with {checkpoint['count']} records", file=sys.stderr)
+        file = open(output, "r+")
+        file.truncate(checkpoint["offset"])
+        file.seek(checkpoint["offset"])
+        return RecordWriter(file, jsonl, checkpoint["count"]), checkpoint["page"] + 1
+
+    return RecordWriter(open(output, "w"), jsonl), 1
+
+# Record the query, the last completed page and the size of the output
+# after all records of this page have been written
+#
+def save_checkpoint(output, query, page, writer):
+    writer.flush()
+    checkpoint = {
+        "query": query,
+        "jsonl": writer.jsonl,
+        "page": page,
+        "offset": os.fstat(writer.file.fileno()).st_size,
+        "count": writer.count
+    }
+    with open(output + ".checkpoint.tmp", "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(output + ".checkpoint.tmp", output + ".checkpoint")
 
-    sys.exit ("Giving up after 5 retries")
+# Remove the checkpoint once the crawl is complete
+#
+def remove_checkpoint(output):
+    if os.path.exists(output + ".checkpoint"):
+        os.remove(output + ".checkpoint")
+
+# Fan-out executor for per-item requests (e.g. one request per ICCID): runs
+# func(item) for the items of an iterable on a pool of 'workers' threads and
+# yields (item, result, error) tuples, in input order if 'ordered' is set or
+# else as they complete. Errors raised by func are returned instead of
+# raised, so one failed item doesn't stop the others. Duplicate items are
+# skipped if 'dedupe' is set, and progress is reported every 'progress' items.
+# Items are read from the iterable as workers become free, so the input may
+# be a generator over a large file
+#
+def fan_out(items, func, workers=1, ordered=True, dedupe=True, progress=100):
+    total = len(items) if hasattr(items, "__len__") else None
+    seen = set()
+    source = iter(items)
+    done = 0
+
+    def next_item():
+        for item in source:
+            if dedupe:
+                if item in seen:
+                    continue
+                seen.add(item)
+            return item, executor.submit(func, item)
+        return None
+
+    def result(item, future):
+        nonlocal done
+        done += 1
+        if progress and done % progress == 0:
+            print(f"Processed {done}" + (f" of {total}" if total is not None else "") + " items", file=sys.stderr)
+        try:
+            return item, future.result(), None
+        except Exception as error:
+            return item, None, error
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.OrderedDict()
+        while True:
+            while len(pending) < workers * 2:
+                submitted = next_item()
+                if submitted is None:
+                    break
+                pending[submitted[1]] = submitted[0]
+            if not pending:
+                break
+
+            if ordered:
+                future, item = pending.popitem(last=False)
+                yield result(item, future)
+            else:
+                finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    yield result(pending.pop(future), future)
+
+# Return True for errors that are not about a single item and would fail
+# for all other items as well: wrong credentials, or no connection to the
+# server even after retrying
+#
+def is_run_error(error):
+    if isinstance(error, AuthenticationError):
+        return True
+    return isinstance(error, RetriesExhaustedError) and error.status is None
+
+# Run func(item) for all items with fan_out and return the results in input
+# order. Without an error file the first failed item raises its error; with
+# an error file the failed items are written to it as CSV (item, error type,
+# message) so that they can be retried later, and the others are returned.
+# Errors that are not about the item (see is_run_error) always end the run
+#
+def run_bulk(items, func, workers=1, errorfile=None, dedupe=True):
+    results = []
+    failed = []
+    for item, result, error in fan_out(items, func, workers, dedupe=dedupe):
+        if error is None:
+            results.append(result)
+        elif errorfile is None or is_run_error(error):
+            raise error
+        else:
+            print (f"Processing {item} failed: {error}", file=sys.stderr)
+            failed.append([item, type(error).__name__, str(error)])
+
+    if errorfile is not None:
+        with open(errorfile, "w", newline="") as file:
+            csv.writer(file).writerows(failed)
+    if failed:
+        print (f"{len(failed)} items failed", file=sys.stderr)
+
+    return results
+
+# HTTP adapter for SOAP sessions that applies the rate limiter and records
+# the request statistics, as get_data does for REST requests
+#
+class SoapAdapter(HTTPAdapter):
+
+    def send(self, request, **kwargs):
+        soap_last_request.url = request.url
+        throttle(request.url)
+        started = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except RequestException:
+            record_request(request.url, "error", time.monotonic() - started)
+            raise
+        # Don't read a streamed response here, the caller parses it
+        #
+        if kwargs.get("stream"):
+            size = int(response.headers.get("Content-Length", 0))
+        else:
+            size = len(response.content)
+        record_request(request.url, response.status_code, time.monotonic() - started, size)
+        return response
+
+# Create the session for SOAP calls: a pooled keep-alive session sized by
+# the "poolsize" site option, retrying failed connection attempts and 503
+# responses up to "soapretries" times (default 3) with backoff. Only
+# requests that weren't processed are retried: a 502 or 504 from a gateway
+# or an error after the request was sent may come after the backend already
+# ran the operation. Faults are retried by soap_call, not here
+#
+def get_soap_session(settings):
+    retries = Retry(
+        total=int(settings.get("soapretries", 3)),
+        read=0,
+        other=0,
+        status_forcelist=[503],
+        allowed_methods=None,
+        backoff_factor=1,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = SoapAdapter(pool_connections=1, pool_maxsize=int(settings.get("poolsize", 10)), max_retries=retries)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# Create the transport for SOAP clients on a SOAP session, with a timeout
+# of "soaptimeout" seconds (default 300) for each call
+#
+def get_soap_transport(settings, cache):
+    timeout = float(settings.get("soaptimeout", 300))
+    return Transport(cache=cache, session=get_soap_session(settings), timeout=timeout, operation_timeout=timeout)
+
+# Create a SOAP client for the WSDL URL with the SOAP action set in the
+# header. The WSDL and the imported schemas are kept in an on-disk cache per
+# site and WSDL URL for "wsdlcache" seconds (default one week), so they
+# aren't downloaded on every run; refresh=True downloads them again
+#
+def get_soap_client(settings, url, soap_action, wsse=True, refresh=False):
+    site = next((name for name, values in site_settings.items() if values is settings), "default")
+    cachefile = os.path.join(get_cache_dir(url, "wsdl"), site + "-" + hashlib.sha256(url.encode()).hexdigest()[:16] + ".sqlite")
+    if refresh and os.path.exists(cachefile):
+        os.remove(cachefile)
+
+    transport = get_soap_transport(settings, zeep.cache.SqliteCache(path=cachefile, timeout=int(settings.get("wsdlcache", 7 * 24 * 3600))))
+
+    if wsse:
+        client = zeep.Client(url, wsse=UsernameToken(settings["username"], settings["password"]), transport=transport)
+    else:
+        client = zeep.Client(url, transport=transport)
+
+    client.transport.session.headers['SOAPAction'] = soap_action
+    return client
+
+# Call a SOAP operation, e.g. client.service.GetTerminalDetails or a function
+# doing such calls, and retry it if it fails with a fault whose code is
+# transient according to 'retryable' (see SoapErrorRetryable in
+# SOAP/errors.py). The backoff follows the retry policy of the site, as for
+# REST requests; after the last try the fault is raised to the caller. The
+# retries are counted in the statistics for the endpoint of the service
+#
+def soap_call(settings, retryable, operation, *args, **kwargs):
+    url = str(settings["soapurl"])
+    policy = get_retry_policy(url)
+    started = time.monotonic()
+
+    for attempt in range(policy.tries):
+        try:
+            return operation(*args, **kwargs)
+        except zeep.exceptions.Fault as fault:
+            if not retryable(fault.message):
+                raise
+            delay = policy.next_delay(attempt, started)
+            if delay is None:
+                print(f"Received SOAP fault {fault.message}; giving up after {attempt + 1} tries", file=sys.stderr)
+                raise
+            print(f"Received SOAP fault {fault.message}; retrying in {delay:.1f} seconds", file=sys.stderr)
+            record_retry(getattr(soap_last_request, "url", url))
+            time.sleep(delay)
+
+# Return the qualified name of an element of the SOAP API schema, e.g. to
+# precompile the tags that soap_iterparse looks for
+#
+def soap_tag(name):
+    return "{" + SOAP_SCHEMA_NS + "}" + name
+
+# Build the SOAP envelope for an operation with the WS-Security username
+# token of the site. The fields are a dict of element names and values in
+# the order of the schema; fields with the value None are left out
+#
+def build_soap_envelope(settings, operation, fields):
+    escape = xml.sax.saxutils.escape
+    body = "".join(f"<s:{name}>{escape(str(value))}</s:{name}>" for name, value in fields.items() if value is not None)
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f'<soapenv:Envelope xmlns:soapenv="{SOAP_ENVELOPE_NS}" xmlns:s="{SOAP_SCHEMA_NS}">'
+        f'<soapenv:Header><wsse:Security xmlns:wsse="{WSSE_NS}"><wsse:UsernameToken>'
+        f'<wsse:Username>{escape(settings["username"])}</wsse:Username>'
+        f'<wsse:Password Type="{WSSE_PASSWORD_TEXT}">{escape(str(settings["password"]))}</wsse:Password>'
+        f'</wsse:UsernameToken></wsse:Security></soapenv:Header>'
+        f'<soapenv:Body><s:{operation}Request>{body}</s:{operation}Request></soapenv:Body>'
+        f'</soapenv:Envelope>'
+    ).encode("utf-8")
+
+# Call a SOAP operation without zeep: post the envelope to the service (e.g.
+# "terminal" or "billing") below the "soapurl" of the site and parse the
+# response while it is received, yielding only the elements with the given
+# tags. Each element is cleared after it has been processed, so the memory
+# used doesn't grow with the size of the response. A SOAP fault is raised as
+# zeep.exceptions.Fault with the error code as message, like the zeep client
+# does, so callers can handle both the same way
+#
+def soap_iterparse(settings, service, soap_action, operation, fields, tags):
+    url = str(settings["soapurl"]) + "/ws/service/" + service
+
+    site = next((name for name, values in site_settings.items() if values is settings), "default")
+    with sessions_lock:
+        if site not in soap_sessions:
+            soap_sessions[site] = get_soap_session(settings)
+        session = soap_sessions[site]
+
+    response = session.post(
+        url,
+        data=build_soap_envelope(settings, operation, fields),
+        headers={"Content-Type": "text/xml; charset=utf-8", "SOAPAction": soap_action},
+        timeout=float(settings.get("soaptimeout", 300)),
+        stream=True
+    )
+
+    with response:
+        if response.status_code not in [200, 500]:
+            raise UnexpectedStatusError(f"Received unexpected HTTP error {response.status_code}", url, response.status_code)
+
+        response.raw.decode_content = True
+        for event, element in etree.iterparse(response.raw, events=("end",), tag=list(tags) + ["faultstring"]):
+            if element.tag == "faultstring":
+                raise zeep.exceptions.Fault(element.text)
+            yield element
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
 
 # Function to convert the object returned by the SOAP call to readable JSON
-# (may be called recursively)
+# in a single iterative pass over the zeep object, descending into nested
+# objects and lists. Dates and times are converted to ISO 8601 strings and
+# decimals to strings to keep their precision; None, booleans, numbers and
+# strings are kept as they are
 #
+def convert_zeep_value(value):
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
 def convert_zeep_object(obj):
-    items={}
-    for key in obj:
-        if isinstance(zeep.helpers.serialize_object(obj[key]),dict):
-            items[key]=convert_zeep_object(obj[key])
-        else:
-            items[key] = str(obj[key])
-    return items
+    compound = zeep.xsd.CompoundValue
+
+    if isinstance(obj, compound):
+        result = {}
+        stack = [(obj.__values__, result)]
+    elif isinstance(obj, (dict, list)):
+        result = {} if isinstance(obj, dict) else [None] * len(obj)
+        stack = [(obj, result)]
+    else:
+        return convert_zeep_value(obj)
+
+    while stack:
+        source, target = stack.pop()
+        for key, value in (source.items() if isinstance(source, dict) else enumerate(source)):
+            if isinstance(value, compound):
+                target[key] = {}
+                stack.append((value.__values__, target[key]))
+            elif isinstance(value, dict):
+                target[key] = {}
+                stack.append((value, target[key]))
+            elif isinstance(value, list):
+                target[key] = [None] * len(value)
+                stack.append((value, target[key]))
+            else:
+                target[key] = convert_zeep_value(value)
+    return result
 
 
 def get_filename_from_header(response):
@@ -229,7 +1230,9 @@ def download_file(url, path, username, password, debug=False):
 
         # Initial request to get the filename
         #
-        response = requests.get(url, auth=(username,password), stream=True)
+        session = get_session(url, username, password)
+        throttle(url)
+        response = session.get(url, stream=True)
         response.raise_for_status()
         filename = path + get_filename_from_header(response)
 
@@ -249,7 +1252,8 @@ def download_file(url, path, username, password, debug=False):
             total_size = 0
 
         headers = {'Range': f'bytes={file_size}-'}
-        with requests.get(url, auth=(username,password), headers=headers, stream=True) as response:
+        throttle(url)
+        with session.get(url, headers=headers, stream=True) as response:
 
             # Raise an error if the request was unsuccessful
             response.raise_for_status()